@@ -0,0 +1,507 @@
+"""Local stand-ins for the Zendesk and Smartsheet endpoints used by the sync.
+
+One HTTP server answers both APIs: Zendesk under /api/v2 and Smartsheet
+under /2.0. The data is a synthetic inventory generated from a seed, and
+writes (ticket comments, row updates and additions) are applied to it, so
+a second run sees the results of the first. Every request can be delayed
+by a fixed latency, and each API can be rate limited with 429 responses.
+"""
+import calendar
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ZENDESK_PREFIX = '/api/v2'
+SMARTSHEET_PREFIX = '/2.0'
+
+FORM_ID = 360001
+QUEUE_ID = 9001
+WAITING_QUEUE_ID = 9002
+SHEET_ID = 7001
+
+# Numeric path segments, e.g. the ticket ID in /tickets/123.json
+ID_SEGMENT = re.compile(r'/\d+(?=[/.]|$)')
+ID_SEGMENT_VALUE = re.compile(r'/(\d+)(?=[/.]|$)')
+
+EXPORT_PAGE_SIZE = 1000
+
+# Ticket field title -> field ID; the dropdown fields also get options
+TICKET_FIELDS = {
+    'IMEI #': 1001, 'Serial # Apple only': 1002, 'Brand': 1003, 'Model': 1004, 'Status': 1005,
+    'Deploy Date': 1006, 'Fulfilled By': 1007, 'GL Code - Facility Name': 1008, 'Recipient': 1009, 'Notes': 1010,
+}
+DROPDOWN_VALUES = {
+    'Brand': ['Apple', 'Samsung', 'Google', 'Motorola'],
+    'Model': ['iPhone 13', 'iPhone 14', 'iPhone 15', 'Galaxy S22', 'Galaxy S23', 'Pixel 7', 'Pixel 8', 'Moto G'],
+    'Status': ['Deployed', 'In Stock', 'Returned', 'Lost'],
+    'Fulfilled By': ['IT Support', 'Vendor', 'Warehouse'],
+    'GL Code - Facility Name': [f'{1000 + index} - Facility {index}' for index in range(40)],
+    'Notes': ['New Hire', 'Replacement', 'Upgrade'],
+}
+# Sheet columns in order; the picklist columns share the dropdown values
+SHEET_COLUMNS = ['IMEI #', 'Serial # Apple only', 'Brand', 'Model', 'Status', 'Deploy Date',
+                 'Fulfilled By', 'Ticket #', 'GL Code - Facility Name', 'Recipient', 'Notes']
+
+
+def tag_for(value):
+    return value.lower().replace(' ', '_').replace('-', '_')
+
+
+class Inventory:
+    """Synthetic tickets and sheet rows, and the state the fake APIs change."""
+
+    def __init__(self, devices, devices_per_ticket=3, sheet_coverage=0.7, extra_rows=0.2, seed=1):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sequence = 0  # Change counter used as the incremental export cursor
+        self.version = 1
+
+        self.fields = [
+            {'id': field_id, 'title': title, 'type': 'tagger' if title in DROPDOWN_VALUES else 'text',
+             'updated_at': '2024-01-01T00:00:00Z'}
+            for title, field_id in TICKET_FIELDS.items()
+        ]
+        self.options = {}
+        option_id = 50000
+        for title, values in DROPDOWN_VALUES.items():
+            options = []
+            for value in values:
+                option_id += 1
+                options.append({'id': option_id, 'name': value, 'value': tag_for(value)})
+            self.options[TICKET_FIELDS[title]] = options
+
+        self.tickets = {}
+        self.comments = {}
+        self.jobs = {}  # Job ID -> job status of the update_many calls
+        devices_left = devices
+        ticket_id = 100000
+        sheet_devices = []
+        now = int(time.time())
+        while devices_left > 0:
+            ticket_id += 1
+            count = min(devices_left, rng.randint(1, 2 * devices_per_ticket - 1))
+            devices_left -= count
+            imeis = [str(350000000000000 + rng.randrange(10 ** 14)) for _ in range(count)]
+            values = {title: rng.choice(choices) for title, choices in DROPDOWN_VALUES.items()}
+            values['Deploy Date'] = f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+            recipients = [f'user{rng.randrange(10 ** 6)}' for _ in range(rng.randint(1, count))]
+            custom_fields = [
+                {'id': TICKET_FIELDS['IMEI #'], 'value': ', '.join(imeis)},
+                {'id': TICKET_FIELDS['Serial # Apple only'], 'value': f'SN{rng.randrange(10 ** 8):08d}' if values['Brand'] == 'Apple' else None},
+                {'id': TICKET_FIELDS['Deploy Date'], 'value': values['Deploy Date']},
+                {'id': TICKET_FIELDS['Recipient'], 'value': ', '.join(recipients)},
+            ] + [{'id': TICKET_FIELDS[title], 'value': tag_for(values[title])} for title in DROPDOWN_VALUES]
+            self.sequence += 1
+            self.tickets[ticket_id] = {
+                'id': ticket_id,
+                'status': 'closed' if rng.random() < 0.05 else rng.choice(['new', 'open', 'pending']),
+                'group_id': QUEUE_ID if rng.random() < 0.8 else WAITING_QUEUE_ID,
+                'ticket_form_id': FORM_ID,
+                'updated_at': now,
+                'custom_fields': custom_fields,
+                '_sequence': self.sequence,
+            }
+            self.comments[ticket_id] = [{'id': 1, 'body': 'Device request received.', 'public': True}]
+            for index, imei in enumerate(imeis):
+                if rng.random() < sheet_coverage:
+                    # Some devices are already on the sheet, a few with stale values or a leading apostrophe
+                    stale = rng.random() < 0.3
+                    sheet_devices.append({
+                        'IMEI #': f"'{imei}" if rng.random() < 0.05 else imei,
+                        'Brand': values['Brand'],
+                        'Model': rng.choice(DROPDOWN_VALUES['Model']) if stale else values['Model'],
+                        'Status': 'In Stock' if stale else values['Status'],
+                        'Deploy Date': values['Deploy Date'],
+                        'Ticket #': str(ticket_id),
+                        'Recipient': recipients[index % len(recipients)],
+                    })
+        for _ in range(int(devices * extra_rows)):
+            sheet_devices.append({
+                'IMEI #': str(350000000000000 + rng.randrange(10 ** 14)),
+                'Brand': rng.choice(DROPDOWN_VALUES['Brand']),
+                'Status': 'In Stock',
+            })
+
+        self.columns = []
+        for index, title in enumerate(SHEET_COLUMNS):
+            column = {'id': 800000 + index, 'index': index, 'title': title, 'type': 'TEXT_NUMBER', 'primary': index == 0}
+            if title in DROPDOWN_VALUES:
+                column['type'] = 'PICKLIST'
+                column['options'] = list(DROPDOWN_VALUES[title])
+            self.columns.append(column)
+        self.column_ids = {column['title']: column['id'] for column in self.columns}
+
+        self.rows = {}
+        self.next_row_id = 5000000
+        for device in sheet_devices:
+            self.add_row([{'columnId': self.column_ids[title], 'value': value} for title, value in device.items()])
+
+    def add_row(self, cells):
+        self.next_row_id += 1
+        row = {'id': self.next_row_id, 'rowNumber': len(self.rows) + 1, 'modifiedAt': time.time(), 'cells': []}
+        values = {cell['columnId']: cell.get('value') for cell in cells}
+        for column in self.columns:
+            value = values.get(column['id'])
+            cell = {'columnId': column['id']}
+            if value not in (None, ''):
+                cell['value'] = value
+                cell['displayValue'] = str(value)
+            row['cells'].append(cell)
+        self.rows[row['id']] = row
+        return row
+
+    def update_row(self, row_id, cells):
+        row = self.rows.get(row_id)
+        if row is None:
+            return None
+        by_column = {cell['columnId']: cell for cell in row['cells']}
+        for cell in cells:
+            current = by_column.get(cell['columnId'])
+            if current is None:
+                continue
+            current.pop('value', None)
+            current.pop('displayValue', None)
+            if cell.get('value') not in (None, ''):
+                current['value'] = cell['value']
+                current['displayValue'] = str(cell['value'])
+        row['modifiedAt'] = time.time()
+        return row
+
+    def sheet(self, query):
+        rows = list(self.rows.values())
+        modified_since = query.get('rowsModifiedSince')
+        if modified_since:
+            since = parse_timestamp(modified_since)
+            rows = [row for row in rows if row['modifiedAt'] >= since]
+        total = len(rows)
+        if 'pageSize' in query:
+            page_size = int(query['pageSize'])
+            page = int(query.get('page', 1))
+            rows = rows[(page - 1) * page_size:page * page_size]
+        columns = self.columns
+        column_ids = query.get('columnIds')
+        if column_ids:
+            wanted = {int(column_id) for column_id in column_ids.split(',')}
+            columns = [column for column in columns if column['id'] in wanted]
+            rows = [dict(row, cells=[cell for cell in row['cells'] if cell['columnId'] in wanted]) for row in rows]
+        return {
+            'id': SHEET_ID, 'name': 'Mobile Inventory', 'version': self.version, 'totalRowCount': total,
+            'columns': columns, 'rows': [format_row(row) for row in rows],
+        }
+
+    def touch_ticket(self, ticket):
+        self.sequence += 1
+        ticket['_sequence'] = self.sequence
+        ticket['updated_at'] = int(time.time())
+
+
+# Smartsheet timestamps are ISO 8601 in UTC, e.g. 2024-05-01T12:00:00Z
+def format_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+def parse_timestamp(value):
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def format_row(row):
+    return dict(row, modifiedAt=format_timestamp(row['modifiedAt']))
+
+
+def public_ticket(ticket):
+    return {key: value for key, value in ticket.items() if not key.startswith('_')}
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second per API; a rate of 0 disables it."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.updated = {}
+
+    # Return 0 if the request may proceed, otherwise the seconds until it may be retried
+    def acquire(self, api):
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.rate, self.tokens.get(api, self.rate) + (now - self.updated.get(api, now)) * self.rate)
+            self.updated[api] = now
+            if tokens >= 1:
+                self.tokens[api] = tokens - 1
+                return 0
+            self.tokens[api] = tokens
+            return (1 - tokens) / self.rate
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # 'METHOD api endpoint' -> count
+        self.rate_limited = 0
+
+    def record(self, key, rate_limited=False):
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if rate_limited:
+                self.rate_limited += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'rate_limited': self.rate_limited,
+                'by_endpoint': dict(sorted(self.requests.items())),
+            }
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so connection pooling behaves as against the real APIs
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'null') if length else None
+        parts = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        server = self.server
+
+        if parts.path == '/_stats':
+            self.send_json(200, server.stats.as_dict())
+            return
+
+        if parts.path.startswith(ZENDESK_PREFIX):
+            api, path, routes = 'zendesk', parts.path[len(ZENDESK_PREFIX):], ZENDESK_ROUTES
+        elif parts.path.startswith(SMARTSHEET_PREFIX):
+            api, path, routes = 'smartsheet', parts.path[len(SMARTSHEET_PREFIX):], SMARTSHEET_ROUTES
+        else:
+            self.send_json(404, {'error': 'NotFound'})
+            return
+
+        endpoint = ID_SEGMENT.sub('/{id}', path)
+        if server.latency:
+            time.sleep(server.latency)
+
+        retry_after = server.limiter.acquire(api)
+        if retry_after:
+            server.stats.record(f'{method} {api} {endpoint}', rate_limited=True)
+            self.send_json(429, {'error': 'TooManyRequests'}, {'Retry-After': str(max(1, math.ceil(retry_after)))})
+            return
+        server.stats.record(f'{method} {api} {endpoint}')
+
+        handler = routes.get((method, endpoint))
+        if handler is None:
+            self.send_json(404, {'error': 'NotFound', 'endpoint': endpoint})
+            return
+        ids = [int(segment) for segment in ID_SEGMENT_VALUE.findall(path)]
+        with server.inventory.lock:
+            status, data = handler(server, ids, query, payload)
+
+        # Zendesk answers GETs with an ETag and honours If-None-Match with an empty 304
+        if api == 'zendesk' and method == 'GET' and status == 200:
+            etag = '"' + hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_json(status, data, {'ETag': etag})
+            return
+        self.send_json(status, data)
+
+
+def base_url(server):
+    return f'http://{server.server_address[0]}:{server.server_address[1]}'
+
+
+# Zendesk handlers: (server, ids from the path, query, JSON body) -> (status, response body)
+
+def zendesk_ticket_fields(server, ids, query, payload):
+    return 200, {'ticket_fields': server.inventory.fields}
+
+def zendesk_field_options(server, ids, query, payload):
+    return 200, {'custom_field_options': server.inventory.options.get(ids[0], [])}
+
+def zendesk_incremental(server, ids, query, payload):
+    inventory = server.inventory
+    if 'cursor' in query:
+        changed = [ticket for ticket in inventory.tickets.values() if ticket['_sequence'] > int(query['cursor'])]
+    else:
+        start_time = int(query.get('start_time', 0))
+        changed = [ticket for ticket in inventory.tickets.values() if ticket['updated_at'] >= start_time]
+    changed.sort(key=lambda ticket: ticket['_sequence'])
+    page = changed[:EXPORT_PAGE_SIZE]
+    cursor = str(page[-1]['_sequence'] if page else int(query.get('cursor', inventory.sequence)))
+    end_of_stream = len(changed) <= EXPORT_PAGE_SIZE
+    return 200, {
+        'tickets': [public_ticket(ticket) for ticket in page],
+        'after_cursor': cursor,
+        'after_url': None if end_of_stream else f'{base_url(server)}{ZENDESK_PREFIX}/incremental/tickets/cursor.json?cursor={cursor}',
+        'end_of_stream': end_of_stream,
+    }
+
+def zendesk_show_many(server, ids, query, payload):
+    wanted = [int(ticket_id) for ticket_id in query.get('ids', '').split(',') if ticket_id]
+    tickets = server.inventory.tickets
+    return 200, {'tickets': [public_ticket(tickets[ticket_id]) for ticket_id in wanted if ticket_id in tickets]}
+
+def zendesk_show_ticket(server, ids, query, payload):
+    ticket = server.inventory.tickets.get(ids[0])
+    if ticket is None:
+        return 404, {'error': 'RecordNotFound'}
+    return 200, {'ticket': public_ticket(ticket)}
+
+def zendesk_comments(server, ids, query, payload):
+    return 200, {'comments': server.inventory.comments.get(ids[0], []), 'next_page': None}
+
+def apply_ticket_changes(inventory, ticket, changes):
+    if 'comment' in changes:
+        comments = inventory.comments.setdefault(ticket['id'], [])
+        comments.append({'id': len(comments) + 1, 'body': changes['comment']['body'], 'public': changes['comment'].get('public', True)})
+    for key in ('group_id', 'status'):
+        if key in changes:
+            ticket[key] = changes[key]
+    inventory.touch_ticket(ticket)
+
+def zendesk_update_ticket(server, ids, query, payload):
+    inventory = server.inventory
+    ticket = inventory.tickets.get(ids[0])
+    if ticket is None:
+        return 404, {'error': 'RecordNotFound'}
+    apply_ticket_changes(inventory, ticket, (payload or {}).get('ticket', {}))
+    return 200, {'ticket': public_ticket(ticket)}
+
+# Batch update: the changes are applied right away and the job is reported as queued until it is polled
+def zendesk_update_many(server, ids, query, payload):
+    inventory = server.inventory
+    changes_list = (payload or {}).get('tickets', [])
+    if len(changes_list) > 100:
+        return 400, {'error': 'TooManyTickets'}
+    results = []
+    for index, changes in enumerate(changes_list):
+        ticket = inventory.tickets.get(changes.get('id'))
+        if ticket is None:
+            results.append({'index': index, 'id': changes.get('id'), 'error': 'TicketUpdateFailed', 'details': 'RecordNotFound'})
+            continue
+        apply_ticket_changes(inventory, ticket, changes)
+        results.append({'index': index, 'id': ticket['id'], 'action': 'update', 'success': True, 'status': 'Updated'})
+    job_id = f'{len(inventory.jobs) + 1:032x}'
+    inventory.jobs[job_id] = {'id': job_id, 'status': 'completed', 'total': len(results), 'progress': len(results),
+                              'message': 'Completed', 'results': results}
+    return 200, {'job_status': {'id': job_id, 'status': 'queued', 'url': f'{base_url(server)}{ZENDESK_PREFIX}/job_statuses/{job_id}.json'}}
+
+def zendesk_job_statuses(server, ids, query, payload):
+    wanted = [job_id for job_id in query.get('ids', '').split(',') if job_id]
+    jobs = server.inventory.jobs
+    return 200, {'job_statuses': [jobs[job_id] for job_id in wanted if job_id in jobs]}
+
+
+# Smartsheet handlers
+
+def smartsheet_version(server, ids, query, payload):
+    return 200, {'version': server.inventory.version}
+
+def smartsheet_sheet(server, ids, query, payload):
+    return 200, server.inventory.sheet(query)
+
+def smartsheet_columns(server, ids, query, payload):
+    columns = server.inventory.columns
+    return 200, {'pageNumber': 1, 'totalPages': 1, 'totalCount': len(columns), 'data': columns}
+
+def smartsheet_update_rows(server, ids, query, payload):
+    inventory = server.inventory
+    updated, failed = [], []
+    for index, row in enumerate(payload or []):
+        result = inventory.update_row(row.get('id'), row.get('cells', []))
+        if result is None:
+            failed.append({'index': index, 'rowId': row.get('id'), 'error': {'errorCode': 1006, 'message': 'Not Found'}})
+        else:
+            updated.append(format_row(result))
+    return smartsheet_bulk_result(inventory, updated, failed, query)
+
+def smartsheet_add_rows(server, ids, query, payload):
+    inventory = server.inventory
+    rows = payload if isinstance(payload, list) else [payload]
+    added = [format_row(inventory.add_row(row.get('cells', []))) for row in rows]
+    return smartsheet_bulk_result(inventory, added, [], query)
+
+def smartsheet_bulk_result(inventory, rows, failed, query):
+    if rows:
+        inventory.version += 1
+    if failed and query.get('allowPartialSuccess') != 'true':
+        return 404, {'errorCode': 1006, 'message': failed[0]['error']['message']}
+    result = {'message': 'PARTIAL_SUCCESS' if failed else 'SUCCESS', 'resultCode': 3 if failed else 0,
+              'version': inventory.version, 'result': rows}
+    if failed:
+        result['failedItems'] = failed
+    return 200, result
+
+
+ZENDESK_ROUTES = {
+    ('GET', '/ticket_fields.json'): zendesk_ticket_fields,
+    ('GET', '/ticket_fields/{id}/options.json'): zendesk_field_options,
+    ('GET', '/incremental/tickets/cursor.json'): zendesk_incremental,
+    ('GET', '/tickets/show_many.json'): zendesk_show_many,
+    ('GET', '/tickets/{id}.json'): zendesk_show_ticket,
+    ('GET', '/tickets/{id}/comments.json'): zendesk_comments,
+    ('PUT', '/tickets/{id}.json'): zendesk_update_ticket,
+    ('PUT', '/tickets/update_many.json'): zendesk_update_many,
+    ('GET', '/job_statuses/show_many.json'): zendesk_job_statuses,
+}
+
+SMARTSHEET_ROUTES = {
+    ('GET', '/sheets/{id}/version'): smartsheet_version,
+    ('GET', '/sheets/{id}'): smartsheet_sheet,
+    ('GET', '/sheets/{id}/columns'): smartsheet_columns,
+    ('PUT', '/sheets/{id}/rows'): smartsheet_update_rows,
+    ('POST', '/sheets/{id}/rows'): smartsheet_add_rows,
+}
+
+
+def create_server(inventory, latency=0.0, rate_limit=0, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), FakeServiceHandler)
+    server.daemon_threads = True
+    server.inventory = inventory
+    server.latency = latency
+    server.limiter = RateLimiter(rate_limit)
+    server.stats = Stats()
+    return server
+
+
+# Process entry point: build the inventory, report the server URL and serve until terminated
+def serve(options, ready_queue):
+    inventory = Inventory(
+        options['devices'], options.get('devices_per_ticket', 3), seed=options.get('seed', 1)
+    )
+    server = create_server(inventory, options.get('latency', 0.0), options.get('rate_limit', 0))
+    ready_queue.put({'url': base_url(server), 'tickets': len(inventory.tickets), 'rows': len(inventory.rows)})
+    server.serve_forever()
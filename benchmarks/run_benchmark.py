@@ -0,0 +1,251 @@
+"""Run the full sync pipeline against local fake Zendesk and Smartsheet servers.
+
+For every inventory size a child process starts the fake servers (see
+fake_services.py) in a process of their own, points the pipeline at them
+through an in-memory credentials module, runs main.run_all_scripts() and
+reports wall time, request counts and peak memory. Nothing is sent to the
+real services and the state files are written to a temporary directory.
+
+    python benchmarks/run_benchmark.py --sizes 1000 10000 --latency 0.02 --rate-limit 200
+
+With --output the results are saved as JSON; with --compare they are checked
+against a saved baseline and the exit status is 1 if a run got slower or sent
+more requests than the tolerance allows.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import urllib.request
+
+try:
+    import resource  # Peak RSS; not available on Windows
+except ImportError:
+    resource = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Relative increase in wall time or request count that --compare reports as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of devices to benchmark')
+    parser.add_argument('--devices-per-ticket', type=int, default=3, help='Average number of devices per ticket')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds each fake request takes')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Requests per second allowed per API (0 for no limit)')
+    parser.add_argument('--runs', type=int, default=1, help='Pipeline runs per size; later runs start from the state of the first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sorted-merge', action='store_true', help='Merge with the sorted merge-join (project_config sorted_merge)')
+    parser.add_argument('--vectorized-transform', action='store_true', help='Transform the merged values with pandas (project_config vectorized_transform)')
+    parser.add_argument('--no-tracemalloc', action='store_true', help='Skip Python allocation tracing (faster, peak RSS only)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file to check the results against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--keep', action='store_true', help='Keep the working directories and pipeline logs')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# Build the credentials module the pipeline imports, pointing every URL at the fake servers
+def install_credentials(base_url, fake_services, workdir, sorted_merge=False, vectorized_transform=False):
+    credentials = types.ModuleType('credentials')
+    credentials.zendesk_subdomain = 'benchmark'
+    credentials.zendesk_email = 'benchmark@example.com'
+    credentials.zendesk_api_token = 'benchmark'
+    credentials.FORM_ID = fake_services.FORM_ID
+    credentials.QUEUE_ID = fake_services.QUEUE_ID
+    credentials.WAITING_QUEUE_ID = fake_services.WAITING_QUEUE_ID
+    credentials.smartsheet_sheet_id = fake_services.SHEET_ID
+    credentials.smartsheet_token = 'benchmark'
+    credentials.smartsheet_api_base_url = f'{base_url}{fake_services.SMARTSHEET_PREFIX}'
+    credentials.desired_fieldnames = list(fake_services.SHEET_COLUMNS)
+    credentials.smartsheet_csv_file = 'smartsheet_data.csv'
+    credentials.zendesk_csv_file = 'zendesk_tickets.csv'
+    credentials.date_format = '%Y-%m-%d'
+    credentials.picklist_fields = ['Brand', 'Model', 'Status', 'Fulfilled By', 'GL Code - Facility Name', 'Notes']
+    credentials.csv_file_names = {'smartsheet_data': 'smartsheet_data.csv'}
+    credentials.project_config = {'csv_files': [], 'metrics_dir': workdir, 'sorted_merge': sorted_merge,
+                                  'vectorized_transform': vectorized_transform}
+    sys.modules['credentials'] = credentials
+    os.environ['ZENDESK_BASE_URL'] = f'{base_url}{fake_services.ZENDESK_PREFIX}'
+
+
+def fetch_server_stats(base_url):
+    with urllib.request.urlopen(f'{base_url}/_stats') as response:
+        return json.load(response)
+
+
+# Child process: benchmark one inventory size and write the results to args.result_file
+def run_child(args):
+    sys.path.insert(0, REPO_DIR)
+    import fake_services
+
+    ready = multiprocessing.Queue()
+    options = {'devices': args.child, 'devices_per_ticket': args.devices_per_ticket, 'latency': args.latency,
+               'rate_limit': args.rate_limit, 'seed': args.seed}
+    server = multiprocessing.Process(target=fake_services.serve, args=(options, ready), daemon=True)
+    server.start()
+    try:
+        info = ready.get(timeout=600)
+        install_credentials(info['url'], fake_services, args.workdir, args.sorted_merge, args.vectorized_transform)
+
+        import comment_ledger
+        import main
+        import metrics
+        import sheet_cache
+        import sheet_mirror
+        import transform_sheet
+        import update_tickets
+        import zendesk_data
+
+        # Keep every state file of the run inside the working directory
+        sheet_cache.CACHE_DIR = os.path.join(args.workdir, '.sheet_cache')
+        zendesk_data.SYNC_STATE_FILE = os.path.join(args.workdir, 'zendesk_sync_state.json')
+        zendesk_data.FIELD_METADATA_FILE = os.path.join(args.workdir, 'zendesk_field_metadata.json')
+        zendesk_data.TICKET_SNAPSHOT_FILE = update_tickets.TICKET_SNAPSHOT_FILE = os.path.join(args.workdir, 'zendesk_ticket_snapshot.json')
+        comment_ledger.LEDGER_FILE = os.path.join(args.workdir, 'comment_ledger.sqlite3')
+        transform_sheet.TRANSFORM_STATE_FILE = os.path.join(args.workdir, 'transform_state.json')
+        sheet_mirror.MIRROR_FILE = os.path.join(args.workdir, 'sheet_mirror.sqlite3')
+        main.RETRY_BACKOFF = 1
+
+        runs = []
+        for run in range(1, args.runs + 1):
+            before = fetch_server_stats(info['url'])
+            if not args.no_tracemalloc:
+                tracemalloc.start()
+            start = time.perf_counter()
+            succeeded = main.run_all_scripts()
+            wall_time = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+            tracemalloc.stop()
+            after = fetch_server_stats(info['url'])
+
+            data = metrics.snapshot()
+            runs.append({
+                'run': run,
+                'succeeded': succeeded,
+                'wall_time': round(wall_time, 3),
+                'requests': after['requests'] - before['requests'],
+                'rate_limited': after['rate_limited'] - before['rate_limited'],
+                'requests_by_endpoint': {
+                    key: count - before['by_endpoint'].get(key, 0)
+                    for key, count in after['by_endpoint'].items() if count != before['by_endpoint'].get(key, 0)
+                },
+                'peak_traced_mb': round(peak / 2 ** 20, 1) if peak is not None else None,
+                'stages': data['stages'],
+                'counters': data['counters'],
+            })
+    finally:
+        server.terminate()
+        server.join()
+
+    # Peak resident set size of this process over all runs (kilobytes on Linux, bytes on macOS)
+    max_rss_mb = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        max_rss_mb = round(max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10, 1)
+    result = {'devices': args.child, 'tickets': info['tickets'], 'sheet_rows': info['rows'],
+              'max_rss_mb': max_rss_mb, 'runs': runs}
+    with open(args.result_file, 'w', encoding='utf-8') as result_file:
+        json.dump(result, result_file, indent=2)
+
+
+# Run one size in a fresh interpreter, so every size starts from clean module state
+def run_size(args, size):
+    workdir = tempfile.mkdtemp(prefix=f'sync_benchmark_{size}_')
+    result_file = os.path.join(workdir, 'result.json')
+    log_file = os.path.join(workdir, 'pipeline.log')
+    command = [sys.executable, os.path.abspath(__file__), '--child', str(size), '--workdir', workdir,
+               '--result-file', result_file, '--devices-per-ticket', str(args.devices_per_ticket),
+               '--latency', str(args.latency), '--rate-limit', str(args.rate_limit),
+               '--runs', str(args.runs), '--seed', str(args.seed)]
+    if args.sorted_merge:
+        command.append('--sorted-merge')
+    if args.vectorized_transform:
+        command.append('--vectorized-transform')
+    if args.no_tracemalloc:
+        command.append('--no-tracemalloc')
+
+    print(f"Benchmarking {size} devices (log: {log_file})...", flush=True)
+    with open(log_file, 'w', encoding='utf-8') as log:
+        completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, cwd=workdir)
+    if completed.returncode != 0 or not os.path.exists(result_file):
+        raise RuntimeError(f"Benchmark for {size} devices failed, see {log_file}")
+
+    with open(result_file, 'r', encoding='utf-8') as results:
+        result = json.load(results)
+    result['workdir'] = workdir if args.keep else None
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def print_results(results):
+    print(f"{'devices':>8} {'tickets':>8} {'run':>4} {'ok':>3} {'wall s':>9} {'requests':>9} {'429s':>6} {'peak MB':>8} {'RSS MB':>8}")
+    for result in results:
+        for run in result['runs']:
+            peak = '-' if run['peak_traced_mb'] is None else f"{run['peak_traced_mb']:.1f}"
+            rss = '-' if result['max_rss_mb'] is None else f"{result['max_rss_mb']:.1f}"
+            print(f"{result['devices']:>8} {result['tickets']:>8} {run['run']:>4} {'yes' if run['succeeded'] else 'no':>3} "
+                  f"{run['wall_time']:>9.2f} {run['requests']:>9} {run['rate_limited']:>6} {peak:>8} {rss:>8}")
+
+
+# Compare wall time and request count per size and run with a baseline; returns the regressions found
+def compare_results(results, baseline, tolerance):
+    baseline_runs = {(result['devices'], run['run']): run for result in baseline for run in result['runs']}
+    regressions = []
+    for result in results:
+        for run in result['runs']:
+            previous = baseline_runs.get((result['devices'], run['run']))
+            if previous is None:
+                continue
+            for key in ('wall_time', 'requests'):
+                if previous[key] and run[key] > previous[key] * (1 + tolerance):
+                    regressions.append(f"{result['devices']} devices, run {run['run']}: {key} {previous[key]} -> {run[key]}")
+            if previous['succeeded'] and not run['succeeded']:
+                regressions.append(f"{result['devices']} devices, run {run['run']}: pipeline failed")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child is not None:
+        run_child(args)
+        return 0
+
+    results = [run_size(args, size) for size in args.sizes]
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as baseline_file:
+            regressions = compare_results(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+
+    return 0 if all(run['succeeded'] for result in results for run in result['runs']) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,138 @@
+"""Compare the row-wise and vectorized (pandas) transforms on large inputs.
+
+Generates synthetic merged rows with the values of the fake services (with
+some noise: other cases, padding, N/A, values missing from the picklists,
+malformed dates) and times, for each size, smartsheet_to_csv.merge_values
+against merge_values_batch and update_smartsheet.prepare_cells against
+prepare_cells_batch. Both paths must give exactly the same output and
+unmatched picklist counts, or the benchmark fails. No server is started.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+DEFAULT_SIZES = [10000, 100000, 500000]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of rows to transform')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    return parser.parse_args(argv)
+
+
+# Mostly clean values, with a share written the way people type them into tickets
+def noisy(rng, value):
+    roll = rng.random()
+    if roll < 0.05:
+        return value.upper()
+    if roll < 0.1:
+        return f'  {value.lower()} '
+    if roll < 0.13:
+        return rng.choice(['', 'N/A', 'NA', 'Unknown', "'quoted'"])
+    return value
+
+
+def generate_rows(fake_services, count, rng):
+    rows = []
+    for _ in range(count):
+        row = {title: noisy(rng, rng.choice(values)) for title, values in fake_services.DROPDOWN_VALUES.items()}
+        row['IMEI #'] = ("'" if rng.random() < 0.05 else '') + str(350000000000000 + rng.randrange(10 ** 14))
+        row['Serial # Apple only'] = f'SN{rng.randrange(10 ** 8):08d}' if rng.random() < 0.3 else ''
+        row['Ticket #'] = str(100000 + rng.randrange(count // 3 + 1))
+        row['Recipient'] = noisy(rng, f'user{rng.randrange(10 ** 6)}')
+        row['Deploy Date'] = rng.choice([f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}', '', '2024-02-30'])
+        rows.append(row)
+    return rows
+
+
+# Time function(rows, resolver) with a fresh resolver; returns (seconds, output, unmatched counts)
+def timed(function, rows, make_resolver):
+    resolver = make_resolver()
+    start = time.perf_counter()
+    output = function(rows, resolver)
+    return time.perf_counter() - start, output, list(resolver.unmatched.items())
+
+
+def benchmark_size(size, seed):
+    import fake_services
+    import smartsheet_to_csv
+    import update_smartsheet
+    from picklist_resolver import PicklistResolver
+
+    rows = generate_rows(fake_services, size, random.Random(seed))
+    options = dict(fake_services.DROPDOWN_VALUES)
+    column_ids = {title: 800000 + index for index, title in enumerate(fake_services.SHEET_COLUMNS)}
+
+    def merge_batches(rows, resolver):
+        return [values for _, _, values in smartsheet_to_csv.iter_merge_values(((row, None) for row in rows), resolver, True)]
+
+    def cells_batches(rows, resolver):
+        return [cells for _, cells in update_smartsheet.iter_prepared_cells(rows, column_ids, resolver, True)]
+
+    comparisons = {
+        'merge_values': (
+            lambda rows, resolver: [smartsheet_to_csv.merge_values(row, resolver) for row in rows],
+            merge_batches,
+            lambda: PicklistResolver(options),
+        ),
+        'prepare_cells': (
+            lambda rows, resolver: [update_smartsheet.prepare_cells(row, column_ids, resolver) for row in rows],
+            cells_batches,
+            lambda: update_smartsheet.build_picklist_resolver(options),
+        ),
+    }
+    result = {'rows': size}
+    for name, (row_wise, vectorized, make_resolver) in comparisons.items():
+        row_seconds, row_output, row_unmatched = timed(row_wise, rows, make_resolver)
+        vector_seconds, vector_output, vector_unmatched = timed(vectorized, rows, make_resolver)
+        result[name] = {
+            'row_wise': round(row_seconds, 3),
+            'vectorized': round(vector_seconds, 3),
+            'speedup': round(row_seconds / vector_seconds, 2) if vector_seconds else None,
+            'identical': row_output == vector_output and row_unmatched == vector_unmatched,
+        }
+    return result
+
+
+def print_results(results):
+    print(f"{'rows':>8} {'transform':<14} {'row-wise s':>11} {'vectorized s':>13} {'speedup':>8} {'identical':>10}")
+    for result in results:
+        for name in ('merge_values', 'prepare_cells'):
+            entry = result[name]
+            print(f"{result['rows']:>8} {name:<14} {entry['row_wise']:>11} {entry['vectorized']:>13} "
+                  f"{entry['speedup']:>8} {'yes' if entry['identical'] else 'NO':>10}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, REPO_DIR)
+    import fake_services
+    from run_benchmark import install_credentials
+    import vectorized_transform
+    if not vectorized_transform.available():
+        print("pandas is not installed, nothing to compare")
+        return 1
+
+    # The transforms only read settings from credentials; no request is made
+    install_credentials('http://127.0.0.1:9', fake_services, BENCHMARK_DIR)
+
+    results = [benchmark_size(size, args.seed) for size in args.sizes]
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to {args.output}")
+    return 0 if all(result[name]['identical'] for result in results for name in ('merge_values', 'prepare_cells')) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
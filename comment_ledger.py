@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import threading
+import time
+
+# SQLite file recording the hash of every comment body known to be on each ticket
+LEDGER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comment_ledger.sqlite3')
+
+
+class CommentLedger:
+    def __init__(self, path=None):
+        # One connection shared by the worker threads, serialized with a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path or LEDGER_FILE, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS comment_hashes ('
+                ' ticket_id TEXT NOT NULL,'
+                ' body_hash TEXT NOT NULL,'
+                ' recorded_at REAL NOT NULL,'
+                ' PRIMARY KEY (ticket_id, body_hash))'
+            )
+
+    # Check whether a comment with this hash is recorded for the ticket
+    def has_comment(self, ticket_id, body_hash):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM comment_hashes WHERE ticket_id = ? AND body_hash = ?',
+                (str(ticket_id), body_hash)
+            ).fetchone()
+        return row is not None
+
+    # Check whether the ledger knows anything about the ticket yet
+    def has_ticket(self, ticket_id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM comment_hashes WHERE ticket_id = ? LIMIT 1', (str(ticket_id),)
+            ).fetchone()
+        return row is not None
+
+    # Record one or more comment hashes for a ticket
+    def record(self, ticket_id, body_hashes):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO comment_hashes (ticket_id, body_hash, recorded_at) VALUES (?, ?, ?)',
+                [(str(ticket_id), body_hash, now) for body_hash in body_hashes]
+            )
+
+    # Drop everything recorded for a ticket, so the next check downloads its comments again
+    def forget(self, ticket_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM comment_hashes WHERE ticket_id = ?', (str(ticket_id),))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
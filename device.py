@@ -0,0 +1,191 @@
+"""Device record passed between the sync scripts.
+
+A Device holds one inventory row in slots instead of a dict keyed by the
+long column titles, which saves several hundred bytes per device on large
+inventories. Picklist values are interned, so the few distinct brands,
+models and statuses are stored once however many devices use them.
+
+Devices also behave like the row dictionaries the scripts used before
+(device['Brand'], device.get('Brand', '')), so csv.DictWriter and older
+callers accept them unchanged. A column whose value is None is treated as
+missing, the same as a key that is not in the dict.
+"""
+import re
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Column title -> attribute name, in the order of the Zendesk CSV
+COLUMN_ATTRIBUTES = {
+    'IMEI #': 'imei',
+    'Serial # Apple only': 'serial',
+    'Brand': 'brand',
+    'Model': 'model',
+    'Status': 'status',
+    'Deploy Date': 'deploy_date',
+    'Fulfilled By': 'fulfilled_by',
+    'Ticket #': 'ticket',
+    'GL Code - Facility Name': 'gl_code',
+    'Recipient': 'recipient',
+    'Notes': 'notes',
+    'QUEUE_ID': 'queue_id',
+    'WAITING_QUEUE_ID': 'waiting_queue_id',
+    'FORM_ID': 'form_id',
+}
+COLUMNS = list(COLUMN_ATTRIBUTES)
+ATTRIBUTES = tuple(COLUMN_ATTRIBUTES.values()) + ('extra',)
+
+# Columns holding one of a handful of picklist values; their values are interned
+PICKLIST_ATTRIBUTES = {'brand', 'model', 'status', 'fulfilled_by', 'gl_code', 'notes', 'queue_id', 'waiting_queue_id', 'form_id'}
+
+
+def intern_value(value):
+    return sys.intern(value) if type(value) is str else value
+
+SPECIAL_CHARACTERS = re.compile(r'[^\w\s-]')
+
+# Normalize text for comparison, e.g. the IMEI key rows are matched on when writing to the sheet;
+# cached because the same values repeat across rows
+@lru_cache(maxsize=4096)
+def normalized_key(text):
+    if not text:
+        return ''
+    text = SPECIAL_CHARACTERS.sub('', text)  # Remove special characters except dash
+    text = ' '.join(text.split())  # Remove extra spaces
+    text = text.strip().upper()  # Remove leading/trailing spaces and convert to uppercase
+    if text.startswith("'"):
+        text = text[1:]  # Remove leading apostrophe
+    return text
+
+
+@dataclass(slots=True)
+class Device:
+    imei: str = None
+    serial: str = None
+    brand: str = None
+    model: str = None
+    status: str = None
+    deploy_date: str = None
+    fulfilled_by: str = None
+    ticket: str = None
+    gl_code: str = None
+    recipient: str = None
+    notes: str = None
+    queue_id: str = None
+    waiting_queue_id: str = None
+    form_id: str = None
+    extra: dict = None  # Columns without an attribute, e.g. other sheet columns in desired_fieldnames
+
+    def __post_init__(self):
+        for name in PICKLIST_ATTRIBUTES:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, intern_value(value))
+
+    # Build a device from a row keyed by column title, e.g. from csv.DictReader
+    @classmethod
+    def from_row(cls, row):
+        device = cls()
+        for title, value in row.items():
+            device[title] = value
+        return device
+
+    # Build a device from Smartsheet cells; column_titles maps column IDs to the titles to keep, and the
+    # fieldnames (all kept titles by default) start out as `default`. Cell values are converted to text
+    # the way they are written to the CSV.
+    @classmethod
+    def from_cells(cls, cells, column_titles, fieldnames=None, default='N/A'):
+        device = cls()
+        for title in fieldnames if fieldnames is not None else column_titles.values():
+            device[title] = default
+        for cell in cells:
+            title = column_titles.get(cell.get('columnId'))
+            if title is None:
+                continue
+            value = cell.get('value', default)
+            device[title] = value.strip() if isinstance(value, str) else ('' if value is None else str(value))
+        return device
+
+    # Build a device from values in the order of titles (e.g. a sheet_cache.SheetRow), with the fieldnames
+    # (all titles by default) starting out as `default`. Empty values are left at `default`, as with from_cells.
+    @classmethod
+    def from_values(cls, values, titles, fieldnames=None, default='N/A'):
+        device = cls()
+        for title in fieldnames if fieldnames is not None else titles:
+            device[title] = default
+        for title, value in zip(titles, values):
+            if value is not None:
+                device[title] = value.strip() if isinstance(value, str) else str(value)
+        return device
+
+    # Return the values as a dict keyed by column title, for the given columns or every column that is set
+    def to_row(self, fieldnames=None):
+        if fieldnames is None:
+            return {title: self[title] for title in self.keys()}
+        return {title: self.get(title, '') for title in fieldnames}
+
+    # Return Smartsheet cells for the columns in column_ids (title -> column ID); missing columns are blank
+    def to_cells(self, column_ids):
+        return [{'columnId': int(column_id), 'value': self.get(title, '')} for title, column_id in column_ids.items()]
+
+    # Copy of the device with some attributes replaced, e.g. one per IMEI of a ticket
+    def replace(self, **changes):
+        device = Device.__new__(Device)  # Values are already interned, so __post_init__ is skipped
+        for name in ATTRIBUTES:
+            setattr(device, name, getattr(self, name))
+        if device.extra is not None:
+            device.extra = dict(device.extra)
+        for name, value in changes.items():
+            setattr(device, name, value)
+        return device
+
+    # Mapping interface, so a device can be used wherever a row dict was
+
+    def __getitem__(self, title):
+        value = self.get(title)
+        if value is None:
+            raise KeyError(title)
+        return value
+
+    def __setitem__(self, title, value):
+        name = COLUMN_ATTRIBUTES.get(title)
+        if name is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[title] = value
+        else:
+            setattr(self, name, intern_value(value) if name in PICKLIST_ATTRIBUTES else value)
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def get(self, title, default=None):
+        name = COLUMN_ATTRIBUTES.get(title)
+        if name is None:
+            value = self.extra.get(title) if self.extra else None
+        else:
+            value = getattr(self, name)
+        return default if value is None else value
+
+    # Titles of the columns that are set, as a set-like view like dict.keys() (csv.DictWriter subtracts it)
+    def keys(self):
+        titles = {title: None for title, name in COLUMN_ATTRIBUTES.items() if getattr(self, name) is not None}
+        if self.extra:
+            titles.update((title, None) for title, value in self.extra.items() if value is not None)
+        return titles.keys()
+
+    def items(self):
+        return [(title, self[title]) for title in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def update(self, values):
+        for title, value in values.items():
+            self[title] = value
+
+
+# Convert rows keyed by column title to devices as they are read; devices are passed through
+def iter_devices(rows):
+    for row in rows:
+        yield row if isinstance(row, Device) else Device.from_row(row)
@@ -0,0 +1,172 @@
+import email.utils
+import logging
+import multiprocessing
+import random
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import metrics
+
+# Seconds to wait for a connection and for a response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Keep-alive connections kept open per host
+POOL_SIZE = 16
+
+# Retry policy: up to MAX_RETRIES retries with exponential backoff and full jitter
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# 429 means the request was rejected before being processed, so it is retried for every method.
+# Server errors, read timeouts and dropped connections are only retried for methods that only read: the
+# writes here post comments and add rows, so repeating one whose outcome is unknown could apply it twice.
+RETRY_STATUSES = {500, 502, 503, 504}
+RATE_LIMIT_STATUS = 429
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# Path prefix of each API, used to charge a request to its API's rate budget
+API_PATH_PREFIXES = {'zendesk': '/api/v2/', 'smartsheet': '/2.0/'}
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Session shared by every REST call so connections are reused across requests and threads
+session = create_session()
+
+
+class RateBudget:
+    """Requests per minute allowed for each API, shared by every process the budget is passed to.
+
+    Each API has a token bucket that refills continuously up to its limit, so bursts of up to a
+    minute's worth of requests go through at once and longer runs settle at the limit. The
+    buckets live in shared memory, so worker processes syncing different sheets together stay
+    within one account-wide limit instead of each assuming it has the whole limit to itself.
+    """
+
+    def __init__(self, limits, context=multiprocessing):
+        self.limits = dict(limits)  # API name -> requests per minute
+        self.lock = context.Lock()
+        self.tokens = {api: context.Value('d', float(limit), lock=False) for api, limit in self.limits.items()}
+        self.refilled_at = {api: context.Value('d', time.time(), lock=False) for api in self.limits}
+
+    # Block until the API has a request to spare and take it
+    def acquire(self, api):
+        limit = self.limits.get(api)
+        if not limit:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                tokens = self.tokens[api]
+                elapsed = max(0.0, now - self.refilled_at[api].value)
+                tokens.value = min(float(limit), tokens.value + elapsed * limit / 60)
+                self.refilled_at[api].value = now
+                if tokens.value >= 1:
+                    tokens.value -= 1
+                    return
+                wait = (1 - tokens.value) * 60 / limit
+            time.sleep(wait)
+
+# Budget every request is charged to; None leaves the APIs' own 429 responses as the only limit
+rate_budget = None
+
+# Name of the API a URL belongs to, or None
+def api_for(url):
+    path = urlsplit(url).path or url
+    for api, prefix in API_PATH_PREFIXES.items():
+        if prefix in path:
+            return api
+    return None
+
+# Wait for the rate budget, if there is one, before sending a request to url
+def throttle(url):
+    if rate_budget is not None:
+        rate_budget.acquire(api_for(url))
+
+# Parse a Retry-After header given either in seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+# Seconds to wait before retry number `attempt` (starting at 1)
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempt - 1))))
+
+def should_retry(method, response):
+    if response.status_code == RATE_LIMIT_STATUS:
+        return True
+    return response.status_code in RETRY_STATUSES and method.upper() in SAFE_METHODS
+
+# Check whether a request that raised never reached the server: the connection could not be opened or timed out
+# while connecting. A read timeout or a connection dropped later may come after the server acted on the request.
+def request_not_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.Timeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def should_retry_error(method, error):
+    return method.upper() in SAFE_METHODS or request_not_sent(error)
+
+# Send a request through the shared session, retrying on rate limits, server errors and dropped connections
+# (only rate limits and connections that could not be opened for writes). Every attempt is recorded in metrics
+# with its latency and status.
+def request(method, url, max_retries=MAX_RETRIES, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 0
+    while True:
+        throttle(url)
+        start = time.monotonic()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe_request(method, url, 'error', time.monotonic() - start)
+            if attempt >= max_retries or not should_retry_error(method, e):
+                raise
+            attempt += 1
+            metrics.increment('http_retries')
+            delay = backoff_delay(attempt)
+            logging.warning("%s %s failed (%s); retry %d/%d in %.1fs", method, url, e, attempt, max_retries, delay)
+            time.sleep(delay)
+            continue
+
+        metrics.observe_request(method, url, response.status_code, time.monotonic() - start)
+        if attempt >= max_retries or not should_retry(method, response):
+            return response
+
+        attempt += 1
+        metrics.increment('http_retries')
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        logging.warning("%s %s returned %s; retry %d/%d in %.1fs", method, url, response.status_code, attempt,
+                        max_retries, delay)
+        time.sleep(delay)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,43 @@
+"""In-memory lookup shared by the sync scripts.
+
+InventoryIndex maps IMEIs to inventory rows so that matching a device is a
+dictionary lookup instead of a scan over every row.
+"""
+
+
+class InventoryIndex:
+    def __init__(self):
+        self.rows_by_imei = {}
+
+    # Index a row under its IMEI; the first row seen for an IMEI is kept unless replace is set
+    def add_row(self, imei, row, replace=False):
+        if not imei:
+            return
+        if replace or imei not in self.rows_by_imei:
+            self.rows_by_imei[imei] = row
+
+    def get(self, imei, default=None):
+        return self.rows_by_imei.get(imei, default)
+
+    def __getitem__(self, imei):
+        return self.rows_by_imei[imei]
+
+    def __contains__(self, imei):
+        return imei in self.rows_by_imei
+
+    def __len__(self):
+        return len(self.rows_by_imei)
+
+    def __iter__(self):
+        return iter(self.rows_by_imei)
+
+    def items(self):
+        return self.rows_by_imei.items()
+
+
+# Build an index from a list of row dicts keyed by their stripped IMEI
+def index_rows(rows, imei_field='IMEI #'):
+    index = InventoryIndex()
+    for row in rows:
+        index.add_row((row.get(imei_field) or '').strip(), row)
+    return index
@@ -0,0 +1,21 @@
+import json
+import os
+
+# Small JSON files that keep state between runs (sync cursor, ticket snapshot, field metadata, transform
+# state); a file that is missing or unreadable counts as no state yet.
+
+# Read a JSON state file, returning default if it is missing or cannot be parsed
+def load_json_file(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
+
+# Write a JSON state file
+def save_json_file(path, data):
+    # Write to a temporary file first so an interrupted run never leaves a truncated state file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
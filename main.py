@@ -1,38 +1,48 @@
+import logging
 import os
-import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from credentials import project_config
+import metrics
+import zendesk_data
+import smartsheet_to_csv
+import transform_sheet
+import update_smartsheet
+import update_tickets
+import vectorized_transform
+from record_stream import SpilledRecords
 
 # Load configuration from credentials.py
-scripts = project_config['scripts']
 csv_files = project_config['csv_files']
 
+# Records stream between stages in memory; set 'debug_csv' in project_config to also write them to the CSV files
+DEBUG_CSV = project_config.get('debug_csv', False)
+
+# Set 'sorted_merge' in project_config to merge by sorting both sides on IMEI and joining them in one pass
+# (see smartsheet_to_csv.iter_sorted_merged_records), which keeps the merge's memory bounded on very large inventories
+SORTED_MERGE = project_config.get('sorted_merge', False)
+
+# Set 'vectorized_transform' in project_config to clean and validate the merged values a column at a time with
+# pandas (see vectorized_transform.py) instead of cell by cell; the output is the same. Ignored without pandas.
+VECTORIZED_TRANSFORM = vectorized_transform.use_vectorized(project_config.get('vectorized_transform', False))
+
+# Per-row debug output is off unless 'log_level' in project_config (or LOG_LEVEL in the environment) is 'DEBUG'
+LOG_LEVEL = project_config.get('log_level', os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Directory for the run's metrics files (sync_metrics.json and the Prometheus textfile sync_metrics.prom)
+METRICS_DIR = project_config.get('metrics_dir', metrics.METRICS_DIR)
+
+# Number of attempts per stage and the base delay before a failed stage is retried (doubled per attempt)
+STAGE_ATTEMPTS = 3
+RETRY_BACKOFF = 5
+
+# Stages that may run at the same time
+MAX_PARALLEL_STAGES = 3
+
 # Function to get the full path of a file in the same directory as the script
 def get_file_path(filename):
     return os.path.join(os.path.dirname(__file__), filename)
 
-# Function to run a script
-def run_script(script):
-    script_path = get_file_path(script)
-    try:
-        print(f"Running {script_path}...")
-        subprocess.check_call(['python', script_path])
-        print(f"Successfully ran {script_path}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to run {script_path}: {e}")
-        return False
-
-# Function to check if required CSV files exist
-def check_csv_files(files, retries=3, delay=2):
-    for attempt in range(retries):
-        missing_files = [get_file_path(file) for file in files if not os.path.isfile(get_file_path(file))]
-        if not missing_files:
-            return True
-        print(f"Attempt {attempt + 1}: Missing files: {', '.join(missing_files)}")
-        time.sleep(delay)
-    return False
-
 # Function to delete created CSV files
 def delete_csv_files(files):
     for file in files:
@@ -41,41 +51,127 @@ def delete_csv_files(files):
             os.remove(file_path)
             print(f"Deleted {file_path}")
 
-# Function to run all scripts and check CSV file existence
-def run_all_scripts():
-    retries = 3
-    while retries > 0:
-        # Run each main script in order
-        success = True
-        
-        # Run the main scripts
-        for script in scripts:
-            if not run_script(script):
-                success = False
-                break  # Exit if any script fails
-        
-        # Add a short delay before checking for CSV files
-        time.sleep(2)
-        
-        # Check if all required CSV files exist
-        if success and check_csv_files(csv_files):
-            print("All scripts ran successfully and all required CSV files are present.")
-            
-            # Wait 3 minutes before deleting all CSV files
-            print("Waiting for 3 minutes before deleting CSV files...")
-            time.sleep(180)  # 3 minutes = 180 seconds
-            
-            # Delete all CSV files created during the script execution
-            delete_csv_files(csv_files)
-            
-            break
-        else:
-            print("One or more files are missing. Rerunning scripts...")
-            retries -= 1
-            if retries > 0:
-                time.sleep(5)  # Wait before retrying
-            else:
-                print("Failed after multiple attempts. Please check the scripts and CSV files.")
+# Stage functions receive the outputs of the stages they depend on, keyed by stage name, along with the
+# run_pipeline context: an already open sheet 'mirror' and loaded 'field_metadata' to reuse, if any
+def pull_zendesk(inputs):
+    return zendesk_data.fetch_ticket_rows(save_csv=DEBUG_CSV, field_metadata=inputs.get('field_metadata'))
+
+# Syncs the local sheet mirror (the one passed in the context, or a new one, which run_pipeline closes); only
+# rows modified since the last sync are downloaded
+def pull_smartsheet(inputs):
+    return smartsheet_to_csv.load_sheet_mirror(inputs.get('mirror'))
+
+# The merged rows are spilled to a temporary file rather than passed on as a stream, so the merge is done (and
+# retried, timed and blamed for its errors) in this stage and every attempt of update_smartsheet reads all of them
+def merge_data(inputs):
+    merged = smartsheet_to_csv.stream_merged_records(inputs['zendesk'], inputs['smartsheet'], debug_csv=DEBUG_CSV,
+                                                     sorted_merge=SORTED_MERGE, vectorized=VECTORIZED_TRANSFORM)
+    return SpilledRecords(merged, smartsheet_to_csv.desired_fieldnames)
+
+def transform_smartsheet(inputs):
+    return transform_sheet.transform_imei_column()
+
+# Looks the rows up in the same mirror, synced again to take in the rows the IMEI transform changed
+def push_smartsheet(inputs):
+    mirror = smartsheet_to_csv.load_sheet_mirror(inputs['smartsheet'])
+    return update_smartsheet.process_data(records=inputs['merge'], mirror=mirror, vectorized=VECTORIZED_TRANSFORM)
+
+def push_tickets(inputs):
+    return update_tickets.main(rows=inputs['zendesk'])
+
+# Stage name -> (stages it depends on, stage function). The Zendesk and Smartsheet pulls are independent,
+# and the IMEI transform only needs the sheet, so those run alongside each other.
+PIPELINE = {
+    'zendesk': ((), pull_zendesk),
+    'smartsheet': ((), pull_smartsheet),
+    'merge': (('zendesk', 'smartsheet'), merge_data),
+    'transform': (('smartsheet',), transform_smartsheet),
+    'update_smartsheet': (('smartsheet', 'merge', 'transform'), push_smartsheet),
+    'update_tickets': (('zendesk', 'update_smartsheet'), push_tickets),
+}
+
+# Function to run one stage, retrying only that stage if it fails; its wall time including retries goes to metrics
+def run_stage(name, stage_function, inputs, attempts=STAGE_ATTEMPTS):
+    stage_start = time.monotonic()
+    for attempt in range(1, attempts + 1):
+        start = time.monotonic()
+        try:
+            print(f"Running stage {name} (attempt {attempt})...")
+            result = stage_function(inputs)
+            print(f"Stage {name} finished in {time.monotonic() - start:.1f}s")
+            metrics.record_stage(name, time.monotonic() - stage_start, attempt, succeeded=True)
+            return result
+        except Exception as e:
+            print(f"Stage {name} failed: {e}")
+            if attempt == attempts:
+                metrics.record_stage(name, time.monotonic() - stage_start, attempt, succeeded=False)
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+# Function to run the stages in dependency order, starting each one as soon as its inputs are ready. Every stage
+# also gets the context (values a long-running caller keeps between runs). Stage outputs holding resources (the
+# sheet mirror's connection, the merged rows' temporary file) are closed once the run is over, whether it
+# succeeded or not, except those that came from the context.
+def run_pipeline(pipeline=PIPELINE, max_parallel=MAX_PARALLEL_STAGES, context=None):
+    context = context or {}
+    results = {}
+    pending = dict(pipeline)
+    running = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while pending or running:
+                for name, (dependencies, stage_function) in list(pending.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        inputs = dict(context)
+                        inputs.update((dependency, results[dependency]) for dependency in dependencies)
+                        running[executor.submit(run_stage, name, stage_function, inputs)] = name
+                        del pending[name]
+
+                if not running:
+                    raise RuntimeError(f"Stages with unmet dependencies: {', '.join(pending)}")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()  # Re-raises the stage's error once its retries are used up
+    finally:
+        # Leaving the executor waited for the stages still running when another one failed
+        for future, name in running.items():
+            if not future.cancelled() and future.exception() is None:
+                results[name] = future.result()
+        for result in results.values():
+            if hasattr(result, 'close') and not any(result is value for value in context.values()):
+                result.close()
+
+    return results
+
+# Function to write the run's metrics, without letting a failed export fail the run
+def export_metrics(succeeded):
+    metrics.finish_run(succeeded)
+    try:
+        json_path, prom_path = metrics.export(METRICS_DIR)
+        print(f"Metrics written to {json_path} and {prom_path}")
+    except OSError as e:
+        print(f"Could not write metrics: {e}")
+
+# Function to run all stages and clean up the CSV files they wrote. A long-running caller may pass its open sheet
+# mirror and loaded (field_ids, dropdown_mappings, field plan) to reuse instead of loading them again.
+def run_all_scripts(mirror=None, field_metadata=None):
+    logging.getLogger().setLevel(LOG_LEVEL.upper())
+    metrics.start_run()
+    start = time.monotonic()
+    try:
+        run_pipeline(context={'mirror': mirror, 'field_metadata': field_metadata})
+    except Exception as e:
+        print(f"Pipeline failed: {e}")
+        export_metrics(succeeded=False)
+        return False
+
+    print(f"All stages ran successfully in {time.monotonic() - start:.1f}s.")
+    export_metrics(succeeded=True)
+    delete_csv_files(csv_files)
+    return True
 
 if __name__ == "__main__":
-    run_all_scripts()
+    raise SystemExit(0 if run_all_scripts() else 1)
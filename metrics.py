@@ -0,0 +1,173 @@
+"""Run metrics for the sync pipeline.
+
+Records wall time per stage, request counts and latency histograms per
+endpoint, and row counters, and exports them as JSON and in the Prometheus
+textfile format. All functions are thread safe, since stages and ticket
+workers run on thread pools.
+"""
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Directory the metrics files are written to unless another one is passed to export()
+METRICS_DIR = os.path.dirname(os.path.abspath(__file__))
+METRICS_JSON_FILE = 'sync_metrics.json'
+METRICS_PROM_FILE = 'sync_metrics.prom'
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Numeric path segments (ticket, sheet and row IDs) are collapsed so each endpoint is one series
+ID_SEGMENT = re.compile(r'/\d+(?=[/.]|$)')
+
+_lock = threading.Lock()
+_stages = {}     # Stage name -> {'seconds', 'attempts', 'status'}
+_requests = {}   # (method, endpoint, status) -> count
+_latency = {}    # (method, endpoint) -> {'buckets': [count per bucket], 'count', 'sum'}
+_counters = {}   # Counter name -> value
+_run = {}        # Start time, end time and outcome of the run
+
+
+# Turn a request URL into an endpoint label, e.g. /api/v2/tickets/{id}/comments.json
+def endpoint_for(url):
+    path = urlsplit(url).path or url
+    return ID_SEGMENT.sub('/{id}', path)
+
+# Record one HTTP request; status is the response status code or 'error' if no response came back
+def observe_request(method, url, status, seconds):
+    method = method.upper()
+    endpoint = endpoint_for(url)
+    with _lock:
+        key = (method, endpoint, str(status))
+        _requests[key] = _requests.get(key, 0) + 1
+
+        histogram = _latency.get((method, endpoint))
+        if histogram is None:
+            histogram = _latency[(method, endpoint)] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+# Add to a named counter, e.g. increment('smartsheet_rows_skipped', unchanged)
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+# Record the outcome of a pipeline stage
+def record_stage(name, seconds, attempts, succeeded):
+    with _lock:
+        _stages[name] = {'seconds': seconds, 'attempts': attempts, 'status': 'ok' if succeeded else 'failed'}
+
+# Start a new run, discarding everything recorded for the previous one
+def start_run():
+    with _lock:
+        for registry in (_stages, _requests, _latency, _counters, _run):
+            registry.clear()
+        _run['started_at'] = time.time()
+
+def finish_run(succeeded):
+    with _lock:
+        _run['finished_at'] = time.time()
+        _run['succeeded'] = succeeded
+
+# Return everything recorded so far as plain data, as written to the JSON file
+def snapshot():
+    with _lock:
+        latency = []
+        for (method, endpoint), histogram in sorted(_latency.items()):
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            buckets['+Inf'] = histogram['count']
+            latency.append({
+                'method': method, 'endpoint': endpoint, 'count': histogram['count'],
+                'sum': round(histogram['sum'], 6), 'buckets': buckets
+            })
+        return {
+            'run': dict(_run),
+            'stages': {name: dict(stage) for name, stage in _stages.items()},
+            'requests': [
+                {'method': method, 'endpoint': endpoint, 'status': status, 'count': count}
+                for (method, endpoint, status), count in sorted(_requests.items())
+            ],
+            'latency': latency,
+            'counters': dict(sorted(_counters.items())),
+        }
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(**labels):
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+# Render a snapshot in the Prometheus text exposition format
+def to_prometheus(data):
+    lines = []
+
+    def metric(name, metric_type, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    run = data['run']
+    if 'finished_at' in run:
+        metric('sync_last_run_timestamp_seconds', 'gauge', 'Time the last pipeline run finished.')
+        lines.append(f"sync_last_run_timestamp_seconds {run['finished_at']:.3f}")
+        metric('sync_last_run_success', 'gauge', 'Whether the last pipeline run succeeded.')
+        lines.append(f"sync_last_run_success {1 if run['succeeded'] else 0}")
+        metric('sync_run_duration_seconds', 'gauge', 'Wall time of the last pipeline run.')
+        lines.append(f"sync_run_duration_seconds {run['finished_at'] - run['started_at']:.3f}")
+
+    if data['stages']:
+        metric('sync_stage_duration_seconds', 'gauge', 'Wall time of each stage in the last run, including retries.')
+        for name, stage in data['stages'].items():
+            lines.append(f"sync_stage_duration_seconds{format_labels(stage=name, status=stage['status'])} {stage['seconds']:.3f}")
+        metric('sync_stage_attempts', 'gauge', 'Attempts each stage needed in the last run.')
+        for name, stage in data['stages'].items():
+            lines.append(f"sync_stage_attempts{format_labels(stage=name)} {stage['attempts']}")
+
+    if data['requests']:
+        metric('sync_http_requests_total', 'counter', 'HTTP requests sent, by endpoint and response status.')
+        for entry in data['requests']:
+            labels = format_labels(method=entry['method'], endpoint=entry['endpoint'], status=entry['status'])
+            lines.append(f"sync_http_requests_total{labels} {entry['count']}")
+
+    if data['latency']:
+        metric('sync_http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint.')
+        for entry in data['latency']:
+            for bound, count in entry['buckets'].items():
+                labels = format_labels(method=entry['method'], endpoint=entry['endpoint'], le=bound)
+                lines.append(f"sync_http_request_duration_seconds_bucket{labels} {count}")
+            labels = format_labels(method=entry['method'], endpoint=entry['endpoint'])
+            lines.append(f"sync_http_request_duration_seconds_sum{labels} {entry['sum']}")
+            lines.append(f"sync_http_request_duration_seconds_count{labels} {entry['count']}")
+
+    for name, value in data['counters'].items():
+        metric(f'sync_{name}_total', 'counter', f"Counter {name}.")
+        lines.append(f'sync_{name}_total {value}')
+
+    return '\n'.join(lines) + '\n'
+
+# Write a file atomically, so a textfile collector never reads a partial file
+def write_file(path, text):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path)
+
+# Write the metrics as JSON and as a Prometheus textfile; returns the two paths
+def export(directory=METRICS_DIR):
+    data = snapshot()
+    json_path = os.path.join(directory, METRICS_JSON_FILE)
+    prom_path = os.path.join(directory, METRICS_PROM_FILE)
+    os.makedirs(directory, exist_ok=True)
+    write_file(json_path, json.dumps(data, indent=2))
+    write_file(prom_path, to_prometheus(data))
+    return json_path, prom_path
@@ -0,0 +1,182 @@
+"""Sync several inventories (sheet, form and queues) in one run.
+
+A job spec lists the inventories. Each one runs the full pipeline from
+main.py in a process of its own, with its own copy of the credentials
+settings and its own directory for the state files (sheet cache and
+mirror, ticket snapshot and cursor, comment ledger, metrics), so module
+level clients and caches never mix inventories. The processes share one
+request budget per API, and a summary of every job is printed and saved
+at the end.
+"""
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+import http_client
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Job spec read when no other file is given on the command line
+JOB_SPEC_FILE = os.path.join(SCRIPT_DIR, 'sync_jobs.json')
+
+# Directory holding one state directory per job
+STATE_ROOT = os.path.join(SCRIPT_DIR, 'tenants')
+SUMMARY_FILE = 'multi_sync_summary.json'
+
+# Requests per minute shared by all jobs unless the spec sets 'rate_limits' (Zendesk's default plan limit
+# and Smartsheet's per-token limit)
+DEFAULT_RATE_LIMITS = {'zendesk': 700, 'smartsheet': 300}
+
+# Settings every job must give, and job names allowed (they name the state directories)
+REQUIRED_SETTINGS = ('smartsheet_sheet_id', 'FORM_ID', 'QUEUE_ID', 'WAITING_QUEUE_ID')
+JOB_NAME = re.compile(r'^[\w-]+$')
+
+# Module attribute -> file name inside the job's state directory ('' for the directory itself)
+STATE_FILES = {
+    ('sheet_cache', 'CACHE_DIR'): '.sheet_cache',
+    ('sheet_mirror', 'MIRROR_FILE'): 'sheet_mirror.sqlite3',
+    ('zendesk_data', 'SYNC_STATE_FILE'): 'zendesk_sync_state.json',
+    ('zendesk_data', 'TICKET_SNAPSHOT_FILE'): 'zendesk_ticket_snapshot.json',
+    ('update_tickets', 'TICKET_SNAPSHOT_FILE'): 'zendesk_ticket_snapshot.json',
+    ('zendesk_data', 'FIELD_METADATA_FILE'): 'zendesk_field_metadata.json',
+    ('comment_ledger', 'LEDGER_FILE'): 'comment_ledger.sqlite3',
+    ('transform_sheet', 'TRANSFORM_STATE_FILE'): 'transform_state.json',
+    ('main', 'METRICS_DIR'): '',
+}
+
+# Counters copied from each job's metrics into the summary
+SUMMARY_COUNTERS = (
+    'zendesk_rows', 'smartsheet_rows_updated', 'smartsheet_rows_added', 'smartsheet_rows_failed',
+    'tickets_updated', 'tickets_error',
+)
+
+
+# Read and check a job spec: {'jobs': [{'name', settings...}], 'max_workers', 'rate_limits'}
+def load_job_spec(path=JOB_SPEC_FILE):
+    with open(path, 'r', encoding='utf-8') as spec_file:
+        spec = json.load(spec_file)
+
+    jobs = spec.get('jobs') or []
+    if not jobs:
+        raise ValueError(f"No jobs in {path}")
+    names = set()
+    for job in jobs:
+        name = str(job.get('name', ''))
+        if not JOB_NAME.match(name):
+            raise ValueError(f"Job name {name!r} must only use letters, digits, '_' and '-'")
+        if name in names:
+            raise ValueError(f"Job name {name!r} is used more than once")
+        names.add(name)
+        missing = [setting for setting in REQUIRED_SETTINGS if setting not in job]
+        if missing:
+            raise ValueError(f"Job {name} is missing {', '.join(missing)}")
+    return spec
+
+# Install a credentials module for one job: the shared credentials.py with the job's settings on top.
+# Records stay in memory, since CSV files next to the scripts would be shared by every job.
+def install_job_credentials(job):
+    import credentials
+
+    job_credentials = types.ModuleType('credentials')
+    job_credentials.__dict__.update(
+        (key, value) for key, value in vars(credentials).items() if not key.startswith('__')
+    )
+    for key, value in job.items():
+        if key not in ('name', 'project_config'):
+            setattr(job_credentials, key, value)
+    job_credentials.project_config = dict(getattr(credentials, 'project_config', {}), **job.get('project_config', {}))
+    job_credentials.project_config['debug_csv'] = False
+    sys.modules['credentials'] = job_credentials
+
+# Worker process set-up: charge every request to the shared budget
+def init_worker(rate_budget):
+    http_client.rate_budget = rate_budget
+
+# Run the pipeline for one job in the current (fresh) worker process and return its summary
+def run_job(job, state_root=STATE_ROOT):
+    name = job['name']
+    state_dir = os.path.join(state_root, name)
+    os.makedirs(state_dir, exist_ok=True)
+    install_job_credentials(job)
+
+    import main
+    import metrics
+    for (module_name, attribute), file_name in STATE_FILES.items():
+        path = os.path.join(state_dir, file_name) if file_name else state_dir
+        setattr(importlib.import_module(module_name), attribute, path)
+
+    print(f"[{name}] Syncing sheet {job['smartsheet_sheet_id']} with form {job['FORM_ID']}")
+    start = time.monotonic()
+    try:
+        succeeded = main.run_all_scripts()
+        error = None if succeeded else 'Pipeline failed'
+    except Exception as e:
+        succeeded, error = False, str(e)
+    data = metrics.snapshot()
+    return {
+        'name': name,
+        'succeeded': succeeded,
+        'error': error,
+        'seconds': round(time.monotonic() - start, 1),
+        'requests': sum(entry['count'] for entry in data['requests']),
+        'counters': {counter: data['counters'].get(counter, 0) for counter in SUMMARY_COUNTERS},
+        'state_dir': state_dir,
+    }
+
+# Run every job of a spec on a pool of processes and return the job summaries in spec order
+def run_jobs(spec, state_root=STATE_ROOT):
+    jobs = spec['jobs']
+    max_workers = spec.get('max_workers') or min(len(jobs), os.cpu_count() or 1)
+    # Spawned processes start without the parent's modules, and each process runs a single job,
+    # so every job imports the scripts with its own credentials
+    context = multiprocessing.get_context('spawn')
+    rate_budget = http_client.RateBudget(spec.get('rate_limits', DEFAULT_RATE_LIMITS), context)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker,
+                             initargs=(rate_budget,), max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_job, job, state_root) for job in jobs]
+        summaries = []
+        for job, future in zip(jobs, futures):
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                # The worker itself died, e.g. a job's settings could not be imported
+                summaries.append({'name': job['name'], 'succeeded': False, 'error': str(e), 'seconds': None,
+                                  'requests': None, 'counters': {}, 'state_dir': os.path.join(state_root, job['name'])})
+    return summaries
+
+# Print one line per job and the totals, and save the summaries as JSON in the state root
+def report_summaries(summaries, state_root=STATE_ROOT):
+    print(f"{'job':<20} {'ok':<4} {'seconds':>8} {'requests':>9} " + ' '.join(f'{counter:>24}' for counter in SUMMARY_COUNTERS))
+    totals = dict.fromkeys(SUMMARY_COUNTERS, 0)
+    for summary in summaries:
+        counters = summary['counters']
+        for counter in SUMMARY_COUNTERS:
+            totals[counter] += counters.get(counter, 0)
+        print(f"{summary['name']:<20} {'yes' if summary['succeeded'] else 'no':<4} {summary['seconds'] or '-':>8} "
+              f"{summary['requests'] if summary['requests'] is not None else '-':>9} "
+              + ' '.join(f'{counters.get(counter, 0):>24}' for counter in SUMMARY_COUNTERS))
+    print(f"{'total':<20} {'':<4} {'':>8} {sum(summary['requests'] or 0 for summary in summaries):>9} "
+          + ' '.join(f'{totals[counter]:>24}' for counter in SUMMARY_COUNTERS))
+    for summary in summaries:
+        if summary['error']:
+            print(f"Job {summary['name']} failed: {summary['error']}")
+
+    os.makedirs(state_root, exist_ok=True)
+    summary_path = os.path.join(state_root, SUMMARY_FILE)
+    with open(summary_path, 'w', encoding='utf-8') as summary_file:
+        json.dump({'finished_at': time.time(), 'jobs': summaries, 'totals': totals}, summary_file, indent=2)
+    print(f"Summary written to {summary_path}")
+
+def main(spec_path=JOB_SPEC_FILE):
+    summaries = run_jobs(load_job_spec(spec_path))
+    report_summaries(summaries)
+    return all(summary['succeeded'] for summary in summaries)
+
+if __name__ == "__main__":
+    raise SystemExit(0 if main(sys.argv[1] if len(sys.argv) > 1 else JOB_SPEC_FILE) else 1)
@@ -0,0 +1,66 @@
+"""Picklist validation shared by the sync scripts.
+
+PicklistResolver is built once per run from the column metadata. It keeps a
+normalized -> canonical option map for every picklist column, so checking a
+value is one normalization plus a dictionary lookup instead of a pass over
+every option, and it counts unmatched values so they can be reported once
+at the end of a run instead of on every cell.
+"""
+from collections import Counter
+from functools import lru_cache
+
+# Number of distinct unmatched values listed per field in the summary
+MAX_REPORTED_VALUES = 10
+
+
+# Default normalization: ignore surrounding spaces and case. Cached because
+# the same handful of values repeats on almost every row.
+@lru_cache(maxsize=4096)
+def normalize_option(value):
+    return value.strip().lower()
+
+
+class PicklistResolver:
+    def __init__(self, picklist_options, normalizer=normalize_option):
+        self.normalizer = normalizer
+        self.options_by_field = {}  # Field -> {normalized option: canonical option}
+        self.unmatched = Counter()  # (field, value) -> number of times seen
+        for field_name, options in picklist_options.items():
+            canonical = {}
+            for option in options or []:
+                canonical.setdefault(normalizer(option), option)  # The first option wins, as with a scan
+            self.options_by_field[field_name] = canonical
+
+    # Check whether a field has any picklist options to validate against
+    def has_options(self, field_name):
+        return bool(self.options_by_field.get(field_name))
+
+    # Return the canonical option matching the value, or None. Misses on fields
+    # with options are counted for report_unmatched; blank values are not.
+    def lookup(self, field_name, value):
+        options = self.options_by_field.get(field_name)
+        if not options:
+            return None
+        option = options.get(self.normalizer(value))
+        if option is None and value.strip():
+            self.unmatched[(field_name, value.strip())] += 1
+        return option
+
+    # Print the unmatched values seen so far, most frequent first, and return how many cells missed
+    def report_unmatched(self):
+        total = sum(self.unmatched.values())
+        if not total:
+            return 0
+
+        by_field = {}
+        for (field_name, value), count in self.unmatched.most_common():
+            by_field.setdefault(field_name, []).append((value, count))
+
+        print(f"{total} picklist values did not match any option:")
+        for field_name, values in by_field.items():
+            listed = ', '.join(f"'{value}' ({count})" for value, count in values[:MAX_REPORTED_VALUES])
+            more = len(values) - MAX_REPORTED_VALUES
+            if more > 0:
+                listed += f", and {more} more"
+            print(f"  {field_name}: {listed}")
+        return total
@@ -0,0 +1,124 @@
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+# Records passed between stages are dictionaries keyed by column title with text values,
+# the same shape csv.DictReader produces, so every stage accepts either a stream or a CSV file.
+
+# Records sort_records sorts in memory before writing them to disk as a sorted run
+SORT_BUFFER_SIZE = 50000
+
+# Yield the records of a CSV file one at a time
+def read_csv_records(file_path):
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        yield from csv.DictReader(csvfile)
+
+# Pass records through unchanged while writing each one to a CSV file
+def csv_sink(records, file_path, fieldnames):
+    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            yield record
+
+# Attach the CSV sink only when it is enabled, e.g. for debugging a pipeline run
+def tee_to_csv(records, file_path, fieldnames, enabled=True):
+    if not enabled:
+        return records
+    return csv_sink(records, file_path, fieldnames)
+
+# Write all records to a CSV file and return them as a list
+def write_csv(records, file_path, fieldnames):
+    return list(csv_sink(records, file_path, fieldnames))
+
+# Write records to a new CSV file in the given directory and return its path. If the records fail partway
+# through, the partial file is removed before the error is re-raised.
+def spill_run(records, fieldnames, directory):
+    handle, file_path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    try:
+        with os.fdopen(handle, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+    except BaseException:
+        os.unlink(file_path)
+        raise
+    return file_path
+
+
+
+class SpilledRecords:
+    """Records written once to a temporary CSV file, which can then be read back as many times as needed.
+
+    A stage's output may be consumed more than once (a failed stage is retried with the same inputs), which a
+    stream cannot do. Iterating yields the records as dictionaries of text; close() removes the file.
+    """
+
+    def __init__(self, records, fieldnames, directory=None):
+        self.file_path = spill_run(records, fieldnames, directory)
+
+    def __iter__(self):
+        return read_csv_records(self.file_path)
+
+    def close(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+# Yield records sorted by key, holding at most buffer_size of them in memory. Larger inputs are written to
+# temporary CSV files (with the given fieldnames) as sorted runs, which are then merged; records read back
+# from a run are dictionaries of text. The sort is stable, so records with equal keys keep their order.
+def sort_records(records, key, fieldnames, buffer_size=SORT_BUFFER_SIZE):
+    buffer = []
+    run_dir = None
+    runs = []
+    try:
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= buffer_size:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix='sort_runs_')
+                buffer.sort(key=key)
+                runs.append(spill_run(buffer, fieldnames, run_dir))
+                buffer = []
+        buffer.sort(key=key)
+        if not runs:
+            yield from buffer
+            return
+
+        runs.append(spill_run(buffer, fieldnames, run_dir))
+        buffer = []
+        readers = [read_csv_records(file_path) for file_path in runs]
+        try:
+            # heapq.merge takes equal keys from the earlier run first, which keeps the sort stable
+            yield from heapq.merge(*readers, key=key)
+        finally:
+            for reader in readers:
+                reader.close()
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+# Join two streams of (key, record) pairs that are sorted by key, yielding (key, left records, right records)
+# for every key on either side, with an empty list for the side that does not have it. Only the records of
+# the current key are held in memory.
+def merge_join(left, right):
+    left_groups = groupby(left, key=itemgetter(0))
+    right_groups = groupby(right, key=itemgetter(0))
+    left_group = next(left_groups, None)
+    right_group = next(right_groups, None)
+    while left_group is not None or right_group is not None:
+        if right_group is None or (left_group is not None and left_group[0] < right_group[0]):
+            yield left_group[0], [record for _, record in left_group[1]], []
+            left_group = next(left_groups, None)
+        elif left_group is None or right_group[0] < left_group[0]:
+            yield right_group[0], [], [record for _, record in right_group[1]]
+            right_group = next(right_groups, None)
+        else:
+            yield left_group[0], [record for _, record in left_group[1]], [record for _, record in right_group[1]]
+            left_group = next(left_groups, None)
+            right_group = next(right_groups, None)
@@ -0,0 +1,157 @@
+import json
+import os
+import time
+from collections import namedtuple
+from hashlib import sha1
+import http_client
+from credentials import smartsheet_token, smartsheet_api_base_url
+
+# Directory where cached Smartsheet responses are kept between scripts of the same run
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '.sheet_cache')
+
+# Seconds a cached response may be reused before it is evicted
+CACHE_TTL = 60 * 60
+
+# Rows requested per page by the paged row reader
+PAGE_SIZE = 5000
+
+# Seconds a fetched sheet version is reused, so the stages of one run share a single version request
+VERSION_TTL = 30
+
+# In-memory copy of the cache for the current process, keyed by (sheet ID, kind)
+_memory_cache = {}
+
+# Sheet versions fetched by this process, keyed by sheet ID: (version, time fetched)
+_versions = {}
+
+# A sheet row reduced to its ID, modifiedAt and the values of the requested columns, in the order they were
+# requested (None for empty cells)
+SheetRow = namedtuple('SheetRow', ['id', 'modified_at', 'values'])
+
+
+def get_headers():
+    return {'Authorization': f'Bearer {smartsheet_token}'}
+
+# Fetch the current version of a sheet without loading its rows, reusing a version fetched less than
+# VERSION_TTL seconds ago unless the sheet has been invalidated since
+def fetch_sheet_version(sheet_id):
+    cached = _versions.get(str(sheet_id))
+    if cached and time.time() - cached[1] < VERSION_TTL:
+        return cached[0]
+
+    url = f'{smartsheet_api_base_url}/sheets/{sheet_id}/version'
+    response = http_client.get(url, headers=get_headers())
+    response.raise_for_status()
+    version = response.json().get('version')
+    _versions[str(sheet_id)] = (version, time.time())
+    return version
+
+# Fetch the IDs of every row in a sheet, reading a single column page by page
+def fetch_row_ids(sheet_id, column_id):
+    return {row.id for row in iter_rows(sheet_id, [column_id])}
+
+# Path of the cache file for a sheet and response kind
+def get_cache_path(sheet_id, kind):
+    return os.path.join(CACHE_DIR, f'{sheet_id}_{kind}.json')
+
+# Load a cache entry from memory or disk, evicting it if it is older than CACHE_TTL
+def load_entry(sheet_id, kind):
+    key = (str(sheet_id), kind)
+    entry = _memory_cache.get(key)
+    if entry is None:
+        try:
+            with open(get_cache_path(sheet_id, kind), 'r', encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    if time.time() - entry.get('fetched_at', 0) > CACHE_TTL:
+        evict_entry(sheet_id, kind)
+        return None
+
+    _memory_cache[key] = entry
+    return entry
+
+# Store a response in memory and on disk under the sheet version it reflects
+def store_entry(sheet_id, kind, version, data):
+    entry = {'version': version, 'fetched_at': time.time(), 'data': data}
+    _memory_cache[(str(sheet_id), kind)] = entry
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(get_cache_path(sheet_id, kind), 'w', encoding='utf-8') as cache_file:
+            json.dump(entry, cache_file)
+    except OSError as e:
+        print(f"Could not write sheet cache for {sheet_id}: {e}")
+    return entry
+
+def evict_entry(sheet_id, kind):
+    _memory_cache.pop((str(sheet_id), kind), None)
+    try:
+        os.remove(get_cache_path(sheet_id, kind))
+    except OSError:
+        pass
+
+# Drop every cached response and the fetched version for a sheet, e.g. after writing to it
+def invalidate(sheet_id):
+    _versions.pop(str(sheet_id), None)
+    kinds = {kind for cached_sheet_id, kind in _memory_cache if cached_sheet_id == str(sheet_id)}
+    try:
+        prefix = f'{sheet_id}_'
+        kinds.update(name[len(prefix):-len('.json')] for name in os.listdir(CACHE_DIR)
+                     if name.startswith(prefix) and name.endswith('.json'))
+    except OSError:
+        pass
+    for kind in kinds | {'columns'}:
+        evict_entry(sheet_id, kind)
+
+# Return the sheet's column definitions (including picklist options) for the current version
+def get_columns(sheet_id):
+    version = fetch_sheet_version(sheet_id)
+    entry = load_entry(sheet_id, 'columns')
+    if entry and entry['version'] == version:
+        return entry['data']
+
+    url = f'{smartsheet_api_base_url}/sheets/{sheet_id}/columns?includeAll=true'
+    response = http_client.get(url, headers=get_headers())
+    response.raise_for_status()
+    columns = response.json().get('data', [])
+    store_entry(sheet_id, 'columns', version, columns)
+    return columns
+
+# Yield the rows of a sheet page by page as SheetRow records, requesting only the given columns and,
+# with modified_since, only the rows modified since then. Nothing is cached.
+def iter_rows(sheet_id, column_ids, modified_since=None, page_size=PAGE_SIZE):
+    url = f'{smartsheet_api_base_url}/sheets/{sheet_id}'
+    params = {'columnIds': ','.join(str(column_id) for column_id in column_ids), 'pageSize': page_size}
+    if modified_since:
+        params['rowsModifiedSince'] = modified_since
+
+    page = 1
+    while True:
+        response = http_client.get(url, headers=get_headers(), params=dict(params, page=page))
+        response.raise_for_status()
+        data = response.json()
+        rows = data.get('rows', [])
+        for row in rows:
+            values = {cell.get('columnId'): cell.get('value') for cell in row.get('cells', [])}
+            yield SheetRow(row['id'], row.get('modifiedAt'), tuple(values.get(column_id) for column_id in column_ids))
+        if len(rows) < page_size or page * page_size >= data.get('totalRowCount', 0):
+            return
+        page += 1
+
+# Return the rows of a sheet as SheetRow records with only the given columns, paging through the sheet
+# only if the cached copy of these columns is for an older version
+def get_rows(sheet_id, column_ids):
+    column_ids = list(column_ids)
+    kind = 'rows_' + sha1(','.join(str(column_id) for column_id in column_ids).encode('utf-8')).hexdigest()[:12]
+    version = fetch_sheet_version(sheet_id)
+    entry = load_entry(sheet_id, kind)
+    if entry and entry['version'] == version:
+        # Rows loaded from disk are plain lists until they are first used
+        if entry['data'] and not isinstance(entry['data'][0], SheetRow):
+            entry['data'] = [SheetRow(*row) for row in entry['data']]
+        return entry['data']
+
+    rows = list(iter_rows(sheet_id, column_ids))
+    store_entry(sheet_id, kind, version, rows)
+    return rows
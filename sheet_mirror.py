@@ -0,0 +1,276 @@
+"""Local SQLite mirror of the inventory sheet.
+
+SheetMirror keeps the rows of a sheet indexed by row ID and IMEI, together
+with the sheet version and the latest row modifiedAt they reflect. sync()
+checks the version: an unchanged sheet is served from the mirror without
+downloading any rows, and a changed one only pulls the rows modified since
+the last sync. The merge and the upsert look devices up in the mirror
+instead of building an index from a full download on every run.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import sheet_cache
+from device import Device, normalized_key
+
+# SQLite file holding the mirrored rows of every synced sheet
+MIRROR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_mirror.sqlite3')
+
+# Title of the column the rows are indexed by
+IMEI_COLUMN = 'IMEI #'
+
+# Rows written to the mirror per executemany call while syncing
+WRITE_BATCH_SIZE = 1000
+
+# Rows fetched per batch when iterating over the mirror
+READ_BATCH_SIZE = 1000
+
+
+# Text of a cell value as the scripts read it: stripped strings, other values converted with str()
+def value_text(value):
+    if value is None:
+        return None
+    return value.strip() if isinstance(value, str) else str(value)
+
+
+class SheetMirror:
+    def __init__(self, sheet_id, path=None):
+        self.sheet_id = str(sheet_id)
+        # One connection that may be handed between pipeline stages, serialized with a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path or MIRROR_FILE, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS mirror_meta ('
+                ' sheet_id TEXT PRIMARY KEY,'
+                ' version INTEGER,'
+                ' columns TEXT NOT NULL,'
+                ' high_water_mark TEXT,'
+                ' synced_at REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS mirror_rows ('
+                ' sheet_id TEXT NOT NULL,'
+                ' row_id INTEGER NOT NULL,'
+                ' position INTEGER NOT NULL,'
+                ' imei TEXT,'
+                ' imei_key TEXT,'
+                ' modified_at TEXT,'
+                ' cell_values TEXT NOT NULL,'
+                ' PRIMARY KEY (sheet_id, row_id))'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS mirror_rows_imei ON mirror_rows (sheet_id, imei, position)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS mirror_rows_imei_key ON mirror_rows (sheet_id, imei_key, position)')
+        self.columns = []  # [(column ID, title)] in the order the values are stored
+        self.projections = {}  # Tuple of fieldnames -> (value positions, titles), see projection()
+        self.version = None
+        self.high_water_mark = None
+        self.load_meta()
+
+    def load_meta(self):
+        with self.lock:
+            meta = self.connection.execute(
+                'SELECT version, columns, high_water_mark FROM mirror_meta WHERE sheet_id = ?', (self.sheet_id,)
+            ).fetchone()
+        if meta is not None:
+            self.version = meta[0]
+            self.columns = [tuple(column) for column in json.loads(meta[1])]
+            self.high_water_mark = meta[2]
+
+    def save_meta(self, version, columns, high_water_mark):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO mirror_meta (sheet_id, version, columns, high_water_mark, synced_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (self.sheet_id, version, json.dumps(columns), high_water_mark, time.time())
+            )
+        self.version, self.columns, self.high_water_mark = version, list(columns), high_water_mark
+        self.projections = {}
+
+    @property
+    def column_ids(self):
+        return [column_id for column_id, _ in self.columns]
+
+    @property
+    def titles(self):
+        return [title for _, title in self.columns]
+
+    # Bring the mirror up to date with the sheet for the given [(column ID, title)] columns.
+    # Returns 'unchanged', 'incremental' or 'full', depending on what had to be fetched.
+    def sync(self, columns):
+        columns = [(column_id, title) for column_id, title in columns]
+        version = sheet_cache.fetch_sheet_version(self.sheet_id)
+        same_columns = columns == self.columns
+        if same_columns and self.version is not None and version == self.version:
+            return 'unchanged'
+
+        if same_columns and self.high_water_mark:
+            high_water_mark = self.pull_rows(modified_since=self.high_water_mark)
+            # Deleted rows never show up as modified, so the row IDs are compared with the sheet's: rows gone
+            # from the sheet are dropped, and a mirror lacking some of the sheet's rows is rebuilt. Counting
+            # the rows is not enough, since a row may have been deleted and another added.
+            sheet_row_ids = sheet_cache.fetch_row_ids(self.sheet_id, self.column_ids[0])
+            mirror_row_ids = self.row_ids()
+            if sheet_row_ids <= mirror_row_ids:
+                self.delete_rows(mirror_row_ids - sheet_row_ids)
+                self.save_meta(version, columns, high_water_mark)
+                return 'incremental'
+            print("Sheet mirror is missing rows of the sheet, rebuilding it")
+
+        # Forget the version first, so an interrupted rebuild is not mistaken for an up-to-date mirror
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM mirror_meta WHERE sheet_id = ?', (self.sheet_id,))
+            self.connection.execute('DELETE FROM mirror_rows WHERE sheet_id = ?', (self.sheet_id,))
+        self.version, self.columns, self.high_water_mark = None, columns, None
+        self.save_meta(version, columns, self.pull_rows())
+        return 'full'
+
+    # Fetch the rows (all, or those modified since the given time) page by page and write them to the
+    # mirror, returning the latest modifiedAt seen
+    def pull_rows(self, modified_since=None):
+        column_ids = self.column_ids
+        imei_index = self.titles.index(IMEI_COLUMN) if IMEI_COLUMN in self.titles else None
+        high_water_mark = modified_since
+        with self.lock:
+            position = self.connection.execute(
+                'SELECT COALESCE(MAX(position), 0) FROM mirror_rows WHERE sheet_id = ?', (self.sheet_id,)
+            ).fetchone()[0]
+
+        batch = []
+        pulled = 0
+        for row in sheet_cache.iter_rows(self.sheet_id, column_ids, modified_since=modified_since):
+            position += 1
+            pulled += 1
+            imei = value_text(row.values[imei_index]) if imei_index is not None else None
+            batch.append((self.sheet_id, row.id, position, imei or None, normalized_key(imei) or None,
+                          row.modified_at, json.dumps(row.values)))
+            # Timestamps share one ISO 8601 format, so the latest one is the largest string
+            if row.modified_at and (high_water_mark is None or row.modified_at > high_water_mark):
+                high_water_mark = row.modified_at
+            if len(batch) >= WRITE_BATCH_SIZE:
+                self.write_rows(batch)
+                batch = []
+        self.write_rows(batch)
+        print(f"Pulled {pulled} rows into the sheet mirror")
+        return high_water_mark
+
+    # Insert or replace rows; rows already in the mirror keep their position
+    def write_rows(self, batch):
+        if not batch:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO mirror_rows (sheet_id, row_id, position, imei, imei_key, modified_at, cell_values)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (sheet_id, row_id) DO UPDATE SET imei = excluded.imei, imei_key = excluded.imei_key,'
+                ' modified_at = excluded.modified_at, cell_values = excluded.cell_values',
+                batch
+            )
+
+    # Remove rows that are no longer on the sheet
+    def delete_rows(self, row_ids):
+        if not row_ids:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM mirror_rows WHERE sheet_id = ? AND row_id = ?', [(self.sheet_id, row_id) for row_id in row_ids]
+            )
+        print(f"Removed {len(row_ids)} deleted rows from the sheet mirror")
+
+    def find_row(self, column, value, order):
+        with self.lock:
+            row = self.connection.execute(
+                f'SELECT row_id, modified_at, cell_values FROM mirror_rows'
+                f' WHERE sheet_id = ? AND {column} = ? ORDER BY position {order} LIMIT 1',
+                (self.sheet_id, value)
+            ).fetchone()
+        if row is None:
+            return None
+        return sheet_cache.SheetRow(row[0], row[1], tuple(json.loads(row[2])))
+
+    # The first row (in sheet order) whose IMEI text is imei, as a sheet_cache.SheetRow, or None
+    def find_by_imei(self, imei):
+        return self.find_row('imei', imei, 'ASC') if imei else None
+
+    # The last row (in sheet order) whose normalized IMEI is key, as a sheet_cache.SheetRow, or None
+    def find_by_key(self, key):
+        return self.find_row('imei_key', key, 'DESC') if key else None
+
+    # (value positions, titles) of the mirrored columns that are in fieldnames
+    def projection(self, fieldnames):
+        projection = self.projections.get(tuple(fieldnames))
+        if projection is None:
+            wanted = set(fieldnames)
+            positions = [index for index, title in enumerate(self.titles) if title in wanted]
+            projection = self.projections[tuple(fieldnames)] = (positions, [self.titles[index] for index in positions])
+        return projection
+
+    # The first row with this IMEI as a Device holding the given columns, or None
+    def get_device(self, imei, fieldnames):
+        row = self.find_by_imei(imei)
+        if row is None:
+            return None
+        positions, titles = self.projection(fieldnames)
+        return Device.from_values([row.values[index] for index in positions], titles, fieldnames)
+
+    # Run a query and yield its rows, fetching READ_BATCH_SIZE at a time instead of loading them all
+    def iter_query(self, query, parameters):
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(READ_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    # Yield every mirrored row in sheet order as a sheet_cache.SheetRow
+    def iter_rows(self):
+        for row_id, modified_at, cell_values in self.iter_query(
+                'SELECT row_id, modified_at, cell_values FROM mirror_rows WHERE sheet_id = ? ORDER BY position',
+                (self.sheet_id,)):
+            yield sheet_cache.SheetRow(row_id, modified_at, tuple(json.loads(cell_values)))
+
+    # Yield (IMEI text, Device holding the given columns) for every row, ordered by IMEI and then sheet order.
+    # The order comes from the IMEI index, so nothing is sorted in memory; rows without an IMEI come first,
+    # with '' as their IMEI.
+    def iter_devices_by_imei(self, fieldnames):
+        positions, titles = self.projection(fieldnames)
+        for imei, cell_values in self.iter_query(
+                'SELECT imei, cell_values FROM mirror_rows WHERE sheet_id = ? ORDER BY imei, position',
+                (self.sheet_id,)):
+            values = json.loads(cell_values)
+            yield imei or '', Device.from_values([values[index] for index in positions], titles, fieldnames)
+
+    # IDs of every mirrored row
+    def row_ids(self):
+        return {row_id for (row_id,) in self.iter_query(
+            'SELECT row_id FROM mirror_rows WHERE sheet_id = ?', (self.sheet_id,))}
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM mirror_rows WHERE sheet_id = ?', (self.sheet_id,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Columns of a sheet as [(column ID, title)] in sheet order, from the cached column definitions
+def sheet_columns(sheet_id):
+    return [(column['id'], column['title']) for column in sheet_cache.get_columns(sheet_id)]
+
+# Open the mirror of a sheet and bring it up to date with all of its columns
+def open_mirror(sheet_id, path=None):
+    mirror = SheetMirror(sheet_id, path)
+    try:
+        result = mirror.sync(sheet_columns(sheet_id))
+    except Exception:
+        mirror.close()
+        raise
+    print(f"Sheet mirror for {sheet_id} is at version {mirror.version} ({result})")
+    return mirror
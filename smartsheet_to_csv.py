@@ -1,9 +1,17 @@
-import csv
-import requests
 from datetime import datetime
 import os
+import sys
+import metrics
+import sheet_cache
+import vectorized_transform
+from device import COLUMNS, Device, iter_devices
+from vectorized_transform import DistinctColumn, column_records, count_unmatched, lookup_options
+from inventory_index import index_rows
+from sheet_mirror import SheetMirror, open_mirror, sheet_columns
+from record_stream import csv_sink, merge_join, read_csv_records, sort_records, tee_to_csv, write_csv
+from picklist_resolver import PicklistResolver
 from credentials import (
-    smartsheet_sheet_id, smartsheet_token, smartsheet_api_base_url,
+    smartsheet_sheet_id,
     desired_fieldnames, smartsheet_csv_file, zendesk_csv_file
 )
 
@@ -16,13 +24,7 @@ def format_date(date_str):
 
 # Fetch column definitions and picklist options dynamically
 def fetch_column_definitions():
-    url = f'{smartsheet_api_base_url}/sheets/{smartsheet_sheet_id}/columns'
-    headers = {'Authorization': f'Bearer {smartsheet_token}'}
-
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    columns = response.json().get('data', [])
+    columns = sheet_cache.get_columns(smartsheet_sheet_id)
     column_definitions = {}
     picklist_options = {}
 
@@ -40,117 +42,234 @@ def fetch_column_definitions():
 
     return column_definitions, picklist_options
 
-# Function to validate picklist values
-def validate_picklist(value, field_name, picklist_options):
-    options = [option.strip().lower() for option in picklist_options.get(field_name, [])]
-    formatted_value = value.strip().lower()
-    if formatted_value in options or not options:
+# Function to validate picklist values; unmatched values are reported once per run by the resolver
+def validate_picklist(value, field_name, picklist_resolver):
+    if not picklist_resolver.has_options(field_name) or picklist_resolver.lookup(field_name, value) is not None:
         return value.strip()
-    else:
-        print(f"Invalid value '{value}' for field '{field_name}'.")  # Debug print
-        return 'N/A'
+    return 'N/A'
 
 # Get the full path of a file
 def get_file_path(filename):
     return os.path.join(os.path.dirname(__file__), filename)
 
-# Read data from a CSV file
+# Read data from a CSV file as devices
 def read_csv(file_name):
-    file_path = get_file_path(file_name)
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        return [row for row in reader]
+    return list(iter_devices(read_csv_records(get_file_path(file_name))))
 
-# Fetch data from Smartsheet and save it to CSV
-def fetch_smartsheet_data():
-    url = f'{smartsheet_api_base_url}/sheets/{smartsheet_sheet_id}'
-    headers = {'Authorization': f'Bearer {smartsheet_token}'}
+# Fetch only the desired columns of the sheet, paging through its rows unless they are cached for the current
+# version; returns {'columns': column titles, 'rows': sheet_cache.SheetRow records with values in that order}
+def load_sheet_rows():
+    column_definitions, _ = fetch_column_definitions()
+    columns = [title for title in desired_fieldnames if title in column_definitions]
+    rows = sheet_cache.get_rows(smartsheet_sheet_id, [column_definitions[title] for title in columns])
+    return {'columns': columns, 'rows': rows}
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+# Open the local mirror of the sheet (or bring an already open one up to date), pulling only the rows modified
+# since it was last synced
+def load_sheet_mirror(mirror=None):
+    if mirror is None:
+        return open_mirror(smartsheet_sheet_id)
+    mirror.sync(sheet_columns(smartsheet_sheet_id))
+    return mirror
 
-    data = response.json()
-    write_smartsheet_to_csv(data)
+# Fetch data from Smartsheet (unless it was passed in) and save it to CSV
+def fetch_smartsheet_data(data=None):
+    if data is None:
+        data = load_sheet_rows()
+    return write_smartsheet_to_csv(data)
+
+# Yield a Device per sheet row, with values as text exactly as they are written to the CSV
+def iter_sheet_rows(data):
+    columns = data['columns']
+    for row in data['rows']:
+        yield Device.from_values(row.values, columns, desired_fieldnames)
 
 # Write fetched data to smartsheet_data.csv
 def write_smartsheet_to_csv(data):
     file_path = get_file_path(smartsheet_csv_file)
-    
-    column_definitions, _ = fetch_column_definitions()
-    
-    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=desired_fieldnames)
-        writer.writeheader()
-        
-        for row in data.get('rows', []):
-            formatted_row = {field: 'N/A' for field in desired_fieldnames}
-            for cell in row.get('cells', []):
-                column_id = cell.get('columnId')
-                value = cell.get('value', 'N/A')
-                
-                column_title = next((k for k, v in column_definitions.items() if v == column_id), None)
-                
-                if column_title in formatted_row:
-                    formatted_row[column_title] = value.strip() if isinstance(value, str) else value
-            
-            writer.writerow(formatted_row)
-
-# Sync CSV data with Smartsheet
-def sync_csv_with_smartsheet():
+    return write_csv(iter_sheet_rows(data), file_path, desired_fieldnames)
+
+# Fields of a Zendesk row validated against the picklists, in the order merge_values checks them
+VALIDATED_FIELDS = ['Brand', 'Model', 'Status', 'Fulfilled By', 'GL Code - Facility Name', 'Recipient', 'Notes']
+
+# Values a Zendesk row sets on the device it was matched with (or a new one), validated against the picklists
+def merge_values(row, picklist_resolver):
+    return {
+        'Serial # Apple only': row.get('Serial # Apple only', '').strip() or 'N/A',
+        'Brand': validate_picklist(row.get('Brand', ''), 'Brand', picklist_resolver),
+        'Model': validate_picklist(row.get('Model', ''), 'Model', picklist_resolver),
+        'Status': validate_picklist(row.get('Status', ''), 'Status', picklist_resolver),
+        'Deploy Date': format_date(row.get('Deploy Date', '')),
+        'Fulfilled By': validate_picklist(row.get('Fulfilled By', ''), 'Fulfilled By', picklist_resolver),
+        'Ticket #': row.get('Ticket #', '').strip() or 'N/A',
+        'GL Code - Facility Name': validate_picklist(row.get('GL Code - Facility Name', ''), 'GL Code - Facility Name', picklist_resolver),
+        'Recipient': validate_picklist(row.get('Recipient', ''), 'Recipient', picklist_resolver),
+        'Notes': validate_picklist(row.get('Notes', ''), 'Notes', picklist_resolver)
+    }
+
+# merge_values for a batch of rows, computed a column at a time with pandas (see vectorized_transform.py)
+def merge_values_batch(rows, picklist_resolver):
+    frame = vectorized_transform.rows_frame(rows, ['Serial # Apple only', 'Ticket #', 'Deploy Date'] + VALIDATED_FIELDS)
+    columns = {}
+    for field in ('Serial # Apple only', 'Ticket #'):
+        column = DistinctColumn(frame[field])
+        columns[field] = column.expand(column.values.str.strip().replace('', 'N/A'))
+    column = DistinctColumn(frame['Deploy Date'])
+    columns['Deploy Date'] = column.expand(column.values.map(format_date))
+
+    misses = []
+    for position, field in enumerate(VALIDATED_FIELDS):
+        column = DistinctColumn(frame[field])
+        values = column.values.str.strip()
+        if picklist_resolver.has_options(field):
+            options = lookup_options(column, column.values, field, picklist_resolver, position, misses)
+            values = values.where(options.notna(), 'N/A')
+        columns[field] = column.expand(values)
+    count_unmatched(picklist_resolver, misses)
+    return column_records(columns)
+
+# Yield (Zendesk row, matched device, merged values) for (row, device or None) pairs. With vectorized the values
+# are computed with merge_values_batch, vectorized_transform.BATCH_SIZE rows at a time.
+def iter_merge_values(matches, picklist_resolver, vectorized=False):
+    if not vectorized:
+        for row, device in matches:
+            yield row, device, merge_values(row, picklist_resolver)
+        return
+    for batch in vectorized_transform.batched(matches):
+        values = merge_values_batch([row for row, _ in batch], picklist_resolver)
+        for (row, device), row_values in zip(batch, values):
+            yield row, device, row_values
+
+# Merge Zendesk rows into the Smartsheet devices matched by IMEI (in the mirror or in the given rows), yielding each
+# merged Device as it is produced
+def iter_merged_records(zendesk_data, smartsheet_data, picklist_resolver, vectorized=False):
+    if isinstance(smartsheet_data, SheetMirror):
+        # Look each IMEI up in the mirror's index instead of indexing every sheet row in memory
+        def find_device(imei):
+            return smartsheet_data.get_device(imei, desired_fieldnames)
+    else:
+        find_device = index_rows(iter_devices(smartsheet_data)).get
+    merged = 0
+
+    matches = ((row, find_device(row.get('IMEI #', '').strip())) for row in zendesk_data)
+    for row, device, values in iter_merge_values(matches, picklist_resolver, vectorized):
+        merged += 1
+        if device is None:
+            device = Device(imei=row.get('IMEI #', '').strip())
+        device.update(values)
+        yield device
+
+    metrics.increment('merged_rows', merged)
+    metrics.increment('merge_picklist_unmatched', picklist_resolver.report_unmatched())
+
+# IMEI a record is joined on: the stripped IMEI text, as iter_merged_records matches it
+def imei_key(record):
+    return (record.get('IMEI #') or '').strip()
+
+# (IMEI, device) pairs of the Zendesk rows in IMEI order
+def sorted_zendesk_devices(zendesk_data):
+    for device in iter_devices(sort_records(zendesk_data, imei_key, COLUMNS)):
+        yield imei_key(device), device
+
+# (IMEI, device) pairs of the sheet rows in IMEI order, then sheet order; the mirror reads them in that order
+# from its IMEI index, other rows go through sort_records
+def sorted_sheet_devices(smartsheet_data):
+    if isinstance(smartsheet_data, SheetMirror):
+        yield from smartsheet_data.iter_devices_by_imei(desired_fieldnames)
+        return
+    for device in iter_devices(sort_records(iter_devices(smartsheet_data), imei_key, desired_fieldnames)):
+        yield imei_key(device), device
+
+# Join the Zendesk rows and the sheet devices on IMEI by sorting both sides and walking them together, yielding
+# (kind, Zendesk row, sheet device) with kind 'matched', 'zendesk_only' (device is None) or 'sheet_only' (row is
+# None). Rows without an IMEI never match. Each Zendesk row is matched with the first sheet row holding its IMEI,
+# as in iter_merged_records, and memory stays bounded by the sort buffer whatever the size of either side.
+def iter_joined_records(zendesk_data, smartsheet_data):
+    for imei, zendesk_devices, sheet_devices in merge_join(sorted_zendesk_devices(zendesk_data),
+                                                           sorted_sheet_devices(smartsheet_data)):
+        for row in zendesk_devices:
+            if imei and sheet_devices:
+                yield 'matched', row, sheet_devices[0]
+            else:
+                yield 'zendesk_only', row, None
+        if not (imei and zendesk_devices):
+            for device in sheet_devices:
+                yield 'sheet_only', None, device
+
+# Sorted merge: the same merged devices as iter_merged_records, produced from iter_joined_records in IMEI order
+def iter_sorted_merged_records(zendesk_data, smartsheet_data, picklist_resolver, vectorized=False):
+    counts = dict.fromkeys(('matched', 'zendesk_only', 'sheet_only'), 0)
+
+    def matches():
+        for kind, row, device in iter_joined_records(zendesk_data, smartsheet_data):
+            counts[kind] += 1
+            if kind != 'sheet_only':
+                yield row, device
+
+    for row, device, values in iter_merge_values(matches(), picklist_resolver, vectorized):
+        # A copy per row, since several Zendesk rows may share an IMEI
+        device = device.replace() if device is not None else Device(imei=imei_key(row))
+        device.update(values)
+        yield device
+
+    print(f"Sorted merge: {counts['matched']} matched, {counts['zendesk_only']} only in Zendesk, "
+          f"{counts['sheet_only']} only on the sheet")
+    metrics.increment('merged_rows', counts['matched'] + counts['zendesk_only'])
+    metrics.increment('merge_sheet_only_rows', counts['sheet_only'])
+    metrics.increment('merge_picklist_unmatched', picklist_resolver.report_unmatched())
+
+# Stream merged rows from Zendesk rows and the sheet mirror (or the sheet rows from load_sheet_rows()) without going
+# through the CSV files. With debug_csv the merged rows are also written to the Smartsheet CSV as they pass through,
+# with sorted_merge they come from iter_sorted_merged_records, and with vectorized their values are computed
+# column-wise (see merge_values_batch).
+def stream_merged_records(zendesk_rows, sheet, debug_csv=False, sorted_merge=False, vectorized=False):
+    _, picklist_options = fetch_column_definitions()
+    smartsheet_rows = sheet if isinstance(sheet, SheetMirror) else iter_sheet_rows(sheet)
+    merge = iter_sorted_merged_records if sorted_merge else iter_merged_records
+    merged = merge(zendesk_rows, smartsheet_rows, PicklistResolver(picklist_options), vectorized)
+    return tee_to_csv(merged, get_file_path(smartsheet_csv_file), desired_fieldnames, enabled=debug_csv)
+
+# Sync Zendesk data with Smartsheet; rows and sheet passed in memory are used instead of the CSV files
+def sync_csv_with_smartsheet(zendesk_rows=None, sheet=None):
     smartsheet_csv_file_path = get_file_path(smartsheet_csv_file)
     zendesk_csv_file_path = get_file_path(zendesk_csv_file)
 
-    column_definitions, picklist_options = fetch_column_definitions()
-
-    fetch_smartsheet_data()
-
-    smartsheet_data = read_csv(smartsheet_csv_file_path)
-    zendesk_data = read_csv(zendesk_csv_file_path)
-
-    smartsheet_imei_set = {row['IMEI #'].strip() for row in smartsheet_data}
-
-    updates = []
-
-    for row in zendesk_data:
-        imei = row.get('IMEI #', '').strip()
-        if imei in smartsheet_imei_set:
-            matching_row = next((item for item in smartsheet_data if item['IMEI #'].strip() == imei), None)
-            if matching_row:
-                matching_row.update({
-                    'Serial # Apple only': row.get('Serial # Apple only', '').strip() or 'N/A',
-                    'Brand': validate_picklist(row.get('Brand', ''), 'Brand', picklist_options),
-                    'Model': validate_picklist(row.get('Model', ''), 'Model', picklist_options),
-                    'Status': validate_picklist(row.get('Status', ''), 'Status', picklist_options),
-                    'Deploy Date': format_date(row.get('Deploy Date', '')),
-                    'Fulfilled By': validate_picklist(row.get('Fulfilled By', ''), 'Fulfilled By', picklist_options),
-                    'Ticket #': row.get('Ticket #', '').strip() or 'N/A',
-                    'GL Code - Facility Name': validate_picklist(row.get('GL Code - Facility Name', ''), 'GL Code - Facility Name', picklist_options),
-                    'Recipient': validate_picklist(row.get('Recipient', ''), 'Recipient', picklist_options),
-                    'Notes': validate_picklist(row.get('Notes', ''), 'Notes', picklist_options)
-                })
-            updates.append(matching_row)
-        else:
-            new_row = {
-                'IMEI #': imei,
-                'Serial # Apple only': row.get('Serial # Apple only', '').strip() or 'N/A',
-                'Brand': validate_picklist(row.get('Brand', ''), 'Brand', picklist_options),
-                'Model': validate_picklist(row.get('Model', ''), 'Model', picklist_options),
-                'Status': validate_picklist(row.get('Status', ''), 'Status', picklist_options),
-                'Deploy Date': format_date(row.get('Deploy Date', '')),
-                'Fulfilled By': validate_picklist(row.get('Fulfilled By', ''), 'Fulfilled By', picklist_options),
-                'Ticket #': row.get('Ticket #', '').strip() or 'N/A',
-                'GL Code - Facility Name': validate_picklist(row.get('GL Code - Facility Name', ''), 'GL Code - Facility Name', picklist_options),
-                'Recipient': validate_picklist(row.get('Recipient', ''), 'Recipient', picklist_options),
-                'Notes': validate_picklist(row.get('Notes', ''), 'Notes', picklist_options)
-            }
-            updates.append(new_row)
-
-    with open(smartsheet_csv_file_path, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=desired_fieldnames)
-        writer.writeheader()
-        writer.writerows(updates)
+    smartsheet_data = fetch_smartsheet_data(sheet)
+
+    _, picklist_options = fetch_column_definitions()
+
+    zendesk_data = zendesk_rows if zendesk_rows is not None else read_csv(zendesk_csv_file_path)
+
+    updates = write_csv(
+        iter_merged_records(zendesk_data, smartsheet_data, PicklistResolver(picklist_options)), smartsheet_csv_file_path, desired_fieldnames
+    )
 
     print(f"Updated {len(updates)} records in {smartsheet_csv_file_path}")
+    return updates
+
+# Same output as sync_csv_with_smartsheet, with bounded memory: the Zendesk CSV is read row by row, the sheet comes
+# from the mirror (or the rows passed in), the two are merged with iter_sorted_merged_records, and the merged rows
+# are written straight to the CSV. Returns the number of rows written.
+def sync_csv_sorted(zendesk_rows=None, sheet=None):
+    smartsheet_csv_file_path = get_file_path(smartsheet_csv_file)
+    zendesk_data = zendesk_rows if zendesk_rows is not None else read_csv_records(get_file_path(zendesk_csv_file))
+    smartsheet_data = sheet if sheet is not None else load_sheet_mirror()
+    if not isinstance(smartsheet_data, SheetMirror):
+        smartsheet_data = iter_sheet_rows(smartsheet_data)
+
+    _, picklist_options = fetch_column_definitions()
+    try:
+        merged = iter_sorted_merged_records(zendesk_data, smartsheet_data, PicklistResolver(picklist_options))
+        written = sum(1 for _ in csv_sink(merged, smartsheet_csv_file_path, desired_fieldnames))
+    finally:
+        if sheet is None:
+            smartsheet_data.close()
+
+    print(f"Updated {written} records in {smartsheet_csv_file_path}")
+    return written
 
 if __name__ == '__main__':
-    sync_csv_with_smartsheet()
+    if '--sorted' in sys.argv[1:]:
+        sync_csv_sorted()
+    else:
+        sync_csv_with_smartsheet()
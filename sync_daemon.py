@@ -0,0 +1,279 @@
+"""Long-running sync service.
+
+SyncDaemon runs the full pipeline from main.py on a jittered interval and
+listens on a local HTTP port for webhook events naming a Zendesk ticket.
+Events are debounced per ticket; once a ticket has been quiet for
+WEBHOOK_DEBOUNCE seconds, only its devices are merged into the sheet. The
+HTTP sessions, the cached field metadata and sheet columns, and the sheet
+mirror stay warm between cycles, so a change reaches the sheet within
+seconds instead of waiting for the next scheduled run.
+"""
+import hmac
+import json
+import logging
+import random
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from credentials import project_config, smartsheet_sheet_id
+import main
+import smartsheet_to_csv
+import update_smartsheet
+import zendesk_data
+from sheet_mirror import SheetMirror, open_mirror, sheet_columns
+
+# Seconds between full syncs, spread by up to SYNC_JITTER (a fraction of the interval) either way
+SYNC_INTERVAL = project_config.get('sync_interval', 15 * 60)
+SYNC_JITTER = project_config.get('sync_jitter', 0.1)
+
+# Address the webhook listener binds to; keep it on localhost unless a proxy in front of it checks the callers
+WEBHOOK_HOST = project_config.get('webhook_host', '127.0.0.1')
+WEBHOOK_PORT = project_config.get('webhook_port', 8085)
+
+# If set, events must carry 'Authorization: Bearer <token>'
+WEBHOOK_TOKEN = project_config.get('webhook_token')
+
+# Seconds a ticket must be quiet before it is synced, and the longest a burst of events can hold it back
+WEBHOOK_DEBOUNCE = project_config.get('webhook_debounce', 5)
+WEBHOOK_MAX_DELAY = 30
+
+# Largest event body accepted, in bytes
+MAX_EVENT_SIZE = 1024 * 1024
+
+
+# Seconds until the next full sync, so instances started together do not hit the APIs at the same moment
+def next_interval(interval=SYNC_INTERVAL, jitter=SYNC_JITTER):
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+# Ticket ID named by a webhook event: {"ticket_id": ...}, {"ticket": {"id": ...}} or a Zendesk event with
+# {"detail": {"id": ...}}. Returns the ID as text, or None.
+def ticket_id_from_event(event):
+    if not isinstance(event, dict):
+        return None
+    candidates = [event.get('ticket_id')]
+    for key in ('ticket', 'detail'):
+        if isinstance(event.get(key), dict):
+            candidates.append(event[key].get('id'))
+    for candidate in candidates:
+        if candidate is not None and str(candidate).strip().isdigit():
+            return str(candidate).strip()
+    return None
+
+
+class TicketDebouncer:
+    def __init__(self, delay=WEBHOOK_DEBOUNCE, max_delay=WEBHOOK_MAX_DELAY):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.pending = {}  # Ticket ID -> (time of the first event, time the ticket is due)
+        self.closed = False
+
+    # Record an event; each event pushes the ticket back by `delay`, up to `max_delay` after the first one
+    def add(self, ticket_id):
+        now = time.monotonic()
+        with self.condition:
+            first_event = self.pending[ticket_id][0] if ticket_id in self.pending else now
+            self.pending[ticket_id] = (first_event, min(now + self.delay, first_event + self.max_delay))
+            self.condition.notify()
+
+    # Block until at least one ticket is due and return the IDs of every due ticket; returns [] once closed
+    def wait_due(self):
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                due = [ticket_id for ticket_id, (_, due_at) in self.pending.items() if due_at <= now]
+                if due:
+                    for ticket_id in due:
+                        del self.pending[ticket_id]
+                    return due
+                next_due = min((due_at for _, due_at in self.pending.values()), default=None)
+                self.condition.wait(None if next_due is None else next_due - now)
+            return []
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("Webhook request: " + format, *args)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self.send_json(200, self.server.sync_daemon.status())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        sync_daemon = self.server.sync_daemon
+        # Compared as bytes: compare_digest rejects str with non-ASCII characters instead of returning False
+        if sync_daemon.token and not hmac.compare_digest(
+                self.headers.get('Authorization', '').encode(), f'Bearer {sync_daemon.token}'.encode()):
+            self.send_json(401, {'error': 'Invalid token'})
+            return
+
+        # A malformed or negative length is rejected before anything is read (rfile.read(-1) would block)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_json(400, {'error': 'Invalid Content-Length'})
+            return
+        if length > MAX_EVENT_SIZE:
+            self.send_json(413, {'error': 'Event too large'})
+            return
+        try:
+            event = json.loads(self.rfile.read(length) or b'null')
+        except ValueError:
+            self.send_json(400, {'error': 'Event is not valid JSON'})
+            return
+
+        ticket_id = ticket_id_from_event(event)
+        if ticket_id is None:
+            self.send_json(400, {'error': 'No ticket ID in the event'})
+            return
+        sync_daemon.debouncer.add(ticket_id)
+        self.send_json(202, {'ticket_id': ticket_id, 'status': 'queued'})
+
+
+class SyncDaemon:
+    def __init__(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, interval=SYNC_INTERVAL, token=WEBHOOK_TOKEN):
+        self.interval = interval
+        self.token = token
+        self.debouncer = TicketDebouncer()
+        self.stopping = threading.Event()
+        # Full and single-ticket syncs never write to the sheet at the same time
+        self.sync_lock = threading.Lock()
+        self.mirror = None
+        self.field_metadata = None  # (field_ids, dropdown_mappings, field plan), reloaded after each full sync
+        self.last_full_sync = None
+        self.last_ticket_sync = None
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.sync_daemon = self
+        self.threads = []
+
+    # State reported by GET /health
+    def status(self):
+        return {
+            'last_full_sync': self.last_full_sync,
+            'last_ticket_sync': self.last_ticket_sync,
+            'pending_tickets': len(self.debouncer),
+        }
+
+    # Run the pipeline on the daemon's own mirror and field metadata, so neither is loaded cold every cycle and the
+    # webhook syncs see what the full sync brought in. The metadata is revalidated once per full sync.
+    def run_full_sync(self):
+        with self.sync_lock:
+            self.field_metadata = None
+            field_metadata = self.get_field_metadata()
+            if self.mirror is None:
+                self.mirror = SheetMirror(smartsheet_sheet_id)  # Synced by the pipeline's smartsheet stage
+            succeeded = main.run_all_scripts(mirror=self.mirror, field_metadata=field_metadata)
+        self.last_full_sync = {'finished_at': time.time(), 'succeeded': succeeded}
+
+    # Run a full sync right away and then every SYNC_INTERVAL (jittered) seconds until stopped
+    def full_sync_loop(self):
+        delay = 0
+        while not self.stopping.wait(delay):
+            try:
+                self.run_full_sync()
+            except Exception as e:
+                print(f"Full sync failed: {e}")
+            delay = next_interval(self.interval)
+            print(f"Next full sync in {delay:.0f}s")
+
+    def get_field_metadata(self):
+        if self.field_metadata is None:
+            field_ids, dropdown_mappings = zendesk_data.load_field_metadata()
+            if not field_ids:
+                raise RuntimeError("No ticket fields fetched.")
+            self.field_metadata = (field_ids, dropdown_mappings, zendesk_data.compile_field_plan(field_ids, dropdown_mappings))
+        return self.field_metadata
+
+    def get_mirror(self):
+        if self.mirror is None:
+            self.mirror = open_mirror(smartsheet_sheet_id)
+        else:
+            self.mirror.sync(sheet_columns(smartsheet_sheet_id))
+        return self.mirror
+
+    # Merge the devices of the given tickets into the sheet, without touching any other ticket or row
+    def sync_tickets(self, ticket_ids):
+        with self.sync_lock:
+            field_ids, dropdown_mappings, plan = self.get_field_metadata()
+            tickets = []
+            for ticket_id in ticket_ids:
+                ticket = zendesk_data.fetch_ticket(ticket_id)
+                if ticket is None or not zendesk_data.ticket_in_scope(ticket):
+                    print(f"Ticket {ticket_id} is not in the inventory form and queues, skipping it")
+                    continue
+                tickets.append(ticket)
+
+            rows = zendesk_data.build_ticket_rows(tickets, field_ids, dropdown_mappings, plan)
+            if rows:
+                mirror = self.get_mirror()
+                records = smartsheet_to_csv.stream_merged_records(rows, mirror)
+                update_smartsheet.process_data(records=records, mirror=mirror)
+        self.last_ticket_sync = {'finished_at': time.time(), 'tickets': list(ticket_ids), 'devices': len(rows)}
+        print(f"Synced {len(rows)} devices from tickets {', '.join(ticket_ids)}")
+
+    # Sync tickets as they come due; a failed sync is left to the next full sync
+    def ticket_loop(self):
+        while True:
+            ticket_ids = self.debouncer.wait_due()
+            if not ticket_ids:
+                return
+            try:
+                self.sync_tickets(ticket_ids)
+            except Exception as e:
+                print(f"Sync of tickets {', '.join(ticket_ids)} failed, leaving them to the next full sync: {e}")
+
+    # Serve webhook events until interrupted (Ctrl+C or SIGTERM), running the sync loops alongside
+    def run(self):
+        for target in (self.full_sync_loop, self.ticket_loop):
+            thread = threading.Thread(target=target, name=target.__name__)
+            thread.start()
+            self.threads.append(thread)
+
+        # serve_forever runs on this thread, so the shutdown it waits for is requested from another one
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=self.server.shutdown).start())
+        host, port = self.server.server_address[:2]
+        print(f"Listening for ticket events on http://{host}:{port}")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    # Stop accepting events and wait for a sync in progress to finish
+    def stop(self):
+        print("Stopping, waiting for running syncs to finish...")
+        self.stopping.set()
+        self.debouncer.close()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.mirror is not None:
+            self.mirror.close()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(main.LOG_LEVEL.upper())
+    SyncDaemon().run()
@@ -1,70 +1,116 @@
-import smartsheet
-from credentials import smartsheet_sheet_id, smartsheet_token
-
-# Initialize Smartsheet client
-smartsheet_client = smartsheet.Smartsheet(smartsheet_token)
+import logging
+import os
+import sys
+import requests
+import metrics
+import sheet_cache
+import update_smartsheet
+from json_state import load_json_file, save_json_file
+from credentials import smartsheet_sheet_id
 
 # Specify your sheet ID
 sheet_id = smartsheet_sheet_id
 
-try:
-    # Load the sheet
-    sheet = smartsheet_client.Sheets.get_sheet(sheet_id)
-except smartsheet.exceptions.ApiError as e:
-    print(f"Error loading sheet: {e}")
-    exit(1)  # Exit the script if the sheet could not be loaded
+# File keeping the high-water mark per sheet: the latest row modifiedAt seen by the last run
+TRANSFORM_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transform_state.json')
+
+# Maximum number of rows sent in a single update_rows request
+TRANSFORM_CHUNK_SIZE = 400
+
+# Function to fix one value of the first column, returning it unchanged if it needs no fix
+def fix_imei_value(original_value):
+    # Add leading single quote if not present
+    if not original_value.startswith("'"):
+        updated_value = f"'{original_value}"
+    else:
+        updated_value = original_value
+    
+    # Remove leading single quote if present
+    if updated_value.startswith("'"):
+        updated_value = updated_value.lstrip("'")
+    
+    # Remove '.0' suffix if present
+    if updated_value.endswith(".0"):
+        updated_value = updated_value.rstrip(".0")
+    return updated_value
+
+# Function to load the rows to check as sheet_cache.SheetRow records with only the first column: all rows on the
+# first run (or full_refresh), otherwise only the rows modified since the high-water mark, page by page
+def load_rows(sheet_id, modified_since, full_refresh=False):
+    columns = sheet_cache.get_columns(sheet_id)
+    if not columns:
+        return None
+    first_column = min(columns, key=lambda column: column.get('index', 0))
+
+    if full_refresh or not modified_since:
+        # Reuse the rows cached earlier if the sheet is unchanged
+        return first_column['id'], sheet_cache.get_rows(sheet_id, [first_column['id']])
+
+    rows = list(sheet_cache.iter_rows(sheet_id, [first_column['id']], modified_since=modified_since))
+    logging.info(f"Fetched {len(rows)} rows modified since {modified_since}")
+    return first_column['id'], rows
+
+# Load the rows and fix the values in their first column, returning the number of rows updated.
+# Only rows modified since the last run are checked unless there is no high-water mark yet or full_refresh is set.
+def transform_imei_column(sheet_id=sheet_id, full_refresh=False):
+    state = load_json_file(TRANSFORM_STATE_FILE, {})
+    modified_since = state.get(str(sheet_id))
+    loaded = load_rows(sheet_id, modified_since, full_refresh)
+
+    # Check if the sheet object has rows
+    if loaded is None:
+        print("Failed to retrieve rows from the sheet.")
+        return 0
+    column_id, rows = loaded
 
-# Check if the sheet object has rows
-if hasattr(sheet, 'rows'):
     # Prepare to update rows
-    updated_rows = []
+    entries = []
+    high_water_mark = modified_since
 
     # Iterate through each row in the sheet
-    for row in sheet.rows:
-        # Get the first cell in the row (assuming it's the first column)
-        first_cell = row.cells[0]
-        original_value = str(first_cell.value) if first_cell.value is not None else ""
-
-        # Debug print the original value
-        print(f"Original value: '{original_value}'")
-
-        # Add leading single quote if not present
-        if not original_value.startswith("'"):
-            updated_value = f"'{original_value}"
-        else:
-            updated_value = original_value
-        
-        # Remove leading single quote if present
-        if updated_value.startswith("'"):
-            updated_value = updated_value.lstrip("'")
-        
-        # Remove '.0' suffix if present
-        if updated_value.endswith(".0"):
-            updated_value = updated_value.rstrip(".0")
-
-        # Debug print the updated value
-        print(f"Updated value: '{updated_value}'")
+    for row in rows:
+        # Timestamps share one ISO 8601 format, so the latest one is the largest string
+        if row.modified_at and (high_water_mark is None or row.modified_at > high_water_mark):
+            high_water_mark = row.modified_at
+
+        # Get the value of the first column
+        value = row.values[0]
+        original_value = str(value) if value is not None else ""
+        updated_value = fix_imei_value(original_value)
+        logging.debug("Original value: '%s' Updated value: '%s'", original_value, updated_value)
 
         # Update only if any changes were made
         if updated_value != original_value:
-            # Create the updated cell
-            updated_cell = smartsheet.models.Cell()
-            updated_cell.column_id = first_cell.column_id
-            updated_cell.value = updated_value
-            
-            # Create the updated row
-            updated_row = smartsheet.models.Row()
-            updated_row.id = row.id
-            updated_row.cells.append(updated_cell)
-            
-            # Add the row to the list of rows to update
-            updated_rows.append(updated_row)
-
-    # Check if there are rows to update
-    if updated_rows:
-        smartsheet_client.Sheets.update_rows(sheet_id, updated_rows)
-        print(f"Updated {len(updated_rows)} rows in the first column of the sheet.")
+            entries.append({
+                'imei': updated_value,
+                'cells': [{'columnId': column_id, 'value': updated_value}],
+                'row_id': row.id
+            })
+
+    # Send the fixes in bounded chunks, retrying only the rows that failed
+    failed = 0
+    if entries:
+        report = update_smartsheet.upsert_rows(sheet_id, entries, chunk_size=TRANSFORM_CHUNK_SIZE)
+        sheet_cache.invalidate(sheet_id)  # The cached sheet no longer reflects our writes
+        failed = sum(1 for result in report if result['status'] != 'ok')
+        print(f"Updated {len(entries) - failed} rows in the first column of the sheet.")
+        metrics.increment('imei_cells_transformed', len(entries) - failed)
+        for result in report:
+            if result['status'] != 'ok':
+                print(f"Failed to update row {result['row_id']}: {result['error']}")
     else:
         print("No rows needed updating.")
-else:
-    print("Failed to retrieve rows from the sheet.")
+    metrics.increment('imei_rows_checked', len(rows))
+
+    # Keep the previous mark if a fix failed, so the row is checked again on the next run
+    if not failed and high_water_mark:
+        state[str(sheet_id)] = high_water_mark
+        save_json_file(TRANSFORM_STATE_FILE, state)
+    return len(entries) - failed
+
+if __name__ == '__main__':
+    try:
+        transform_imei_column(full_refresh='--full' in sys.argv)
+    except requests.RequestException as e:
+        print(f"Error loading sheet: {e}")
+        exit(1)  # Exit the script if the sheet could not be loaded
@@ -1,78 +1,89 @@
 import csv
+import logging
 import smartsheet
-import re
 from datetime import datetime
+from hashlib import sha256
 import os
+import time
+import http_client
+import metrics
+import sheet_cache
+import vectorized_transform
+from device import iter_devices, normalized_key
+from sheet_mirror import open_mirror
+from picklist_resolver import PicklistResolver
+from vectorized_transform import DistinctColumn, count_unmatched, lookup_options, normalized_keys
 from credentials import (
     smartsheet_sheet_id,
     smartsheet_token,
+    smartsheet_api_base_url,
     date_format,
     picklist_fields,
     csv_file_names
 )
 
-# Initialize Smartsheet client
-smartsheet_client = smartsheet.Smartsheet(smartsheet_token)
+# Initialize Smartsheet client against the same API base URL as the REST calls
+smartsheet_client = smartsheet.Smartsheet(smartsheet_token, api_base=smartsheet_api_base_url)
+
+# Maximum number of rows sent in a single update_rows/add_rows request
+BULK_CHUNK_SIZE = 400
+
+# Number of times a row is sent before it is reported as failed
+BULK_MAX_ATTEMPTS = 3
 
 # Function to format dates
 def format_date(date_str):
     try:
         formatted_date = datetime.strptime(date_str, date_format).strftime(date_format)
-        print(f"Formatted date: Original: '{date_str}' Formatted: '{formatted_date}'")
+        logging.debug("Formatted date: Original: '%s' Formatted: '%s'", date_str, formatted_date)
         return formatted_date
     except ValueError:
-        print(f"Date formatting error: '{date_str}'")
+        logging.debug("Date formatting error: '%s'", date_str)
         return ''  # Handle error or provide default value
 
 # Normalize text for comparison
 def normalize_text(text, capitalize=False):
     if text:
         original_text = text
-        text = re.sub(r'[^\w\s-]', '', text)  # Remove special characters except dash
-        text = ' '.join(text.split())  # Remove extra spaces
-        text = text.strip().upper()  # Remove leading/trailing spaces and convert to uppercase
-        if text.startswith("'"):
-            text = text[1:]  # Remove leading apostrophe
+        text = normalized_key(text)
         if capitalize:
             text = text.title()  # Capitalize the first letter of each word
-        print(f"Normalized text: Original: '{original_text}' Normalized: '{text}'")
+        logging.debug("Normalized text: Original: '%s' Normalized: '%s'", original_text, text)
         return text
     return ''
 
 # Function to clean facility names
 def clean_facility_name(name):
     cleaned_name = name.strip('"').strip("'")
-    print(f"Cleaned facility name: Original: '{name}' Cleaned: '{cleaned_name}'")
+    logging.debug("Cleaned facility name: Original: '%s' Cleaned: '%s'", name, cleaned_name)
     return cleaned_name
 
-# Function to get column IDs and picklists dynamically from Smartsheet
+# Function to get column IDs and picklists dynamically from Smartsheet, without loading any rows
 def get_column_ids_and_picklists(sheet_id):
-    sheet = smartsheet_client.Sheets.get_sheet(sheet_id)
+    columns = sheet_cache.get_columns(sheet_id)
     column_id_mapping = {}
     picklist_options_mapping = {}
 
-    for column in sheet.columns:
-        column_id_mapping[column.title] = column.id
-        if column.type == "PICKLIST":
-            picklist_options_mapping[column.title] = column.options
+    for column in columns:
+        column_id_mapping[column['title']] = column['id']
+        if column.get('type') == "PICKLIST":
+            picklist_options_mapping[column['title']] = column.get('options', [])
 
     return column_id_mapping, picklist_options_mapping
 
+# Function to build the picklist resolver, matching values the same way normalize_text does
+def build_picklist_resolver(picklist_options_mapping):
+    return PicklistResolver(picklist_options_mapping, normalizer=normalized_key)
+
 # Function to validate and normalize picklist values
-def validate_picklist(value, field_name, picklist_options_mapping):
-    options = picklist_options_mapping.get(field_name, [])
-    normalized_value = normalize_text(value)
-    options_normalized = [normalize_text(opt) for opt in options]  # Normalize options for comparison
-
-    if normalized_value in options_normalized:
-        print(f"Value '{value}' normalized to '{normalized_value}' matches picklist options.")
-        return next((opt for opt in options if normalize_text(opt) == normalized_value), value).strip()  # Return matched value from options
-    else:
-        print(f"Value '{value}' normalized to '{normalized_value}' does not match any picklist options.")
-        return value.strip()  # Return unformatted value if not in options
+def validate_picklist(value, field_name, picklist_resolver):
+    option = picklist_resolver.lookup(field_name, value)
+    if option is not None:
+        return option.strip()  # Return matched value from options
+    return value.strip()  # Return unformatted value if not in options; unmatched values are reported once per run
 
 # Function to prepare cells for Smartsheet
-def prepare_cells(row, column_id_mapping, picklist_options_mapping):
+def prepare_cells(row, column_id_mapping, picklist_resolver):
     cells = []
     for field, column_id in column_id_mapping.items():
         value = row.get(field, '')
@@ -96,98 +107,330 @@ def prepare_cells(row, column_id_mapping, picklist_options_mapping):
         
         # Validate and normalize picklist values
         if field in picklist_fields:
-            value = validate_picklist(value, field, picklist_options_mapping)  # Validate relevant fields
+            value = validate_picklist(value, field, picklist_resolver)  # Validate relevant fields
         
         # Ensure the value is treated as text in Smartsheet
         value = str(value).strip()
         if field == 'IMEI #':
             # Ensure no leading apostrophe in IMEI value
             value = value.lstrip("'")
-        print(f"Prepared cell: Field: '{field}' Value: '{value}' Column ID: {column_id}")
+        logging.debug("Prepared cell: Field: '%s' Value: '%s' Column ID: %s", field, value, column_id)
         cells.append({'columnId': int(column_id), 'value': value})
     return cells
 
+# prepare_cells for a batch of rows, computed a column at a time with pandas (see vectorized_transform.py)
+def prepare_cells_batch(rows, column_id_mapping, picklist_resolver):
+    frame = vectorized_transform.rows_frame(rows, column_id_mapping)
+    columns = {}
+    misses = []
+    for position, field in enumerate(column_id_mapping):
+        column = DistinctColumn(frame[field])
+        values = column.values
+        if field == 'Deploy Date':
+            values = values.map(format_date)
+        if field == 'GL Code - Facility Name':
+            values = values.str.strip('"').str.strip("'")
+        if field not in ['Deploy Date', 'GL Code - Facility Name']:
+            values = normalized_keys(values)
+            if field == 'Recipient':
+                values = values.str.title()
+        values = values.where(~values.isin(['N/A', 'NA']), '')
+        if field in picklist_fields:
+            options = lookup_options(column, values, field, picklist_resolver, position, misses)
+            values = options.where(options.notna(), values).str.strip()
+        values = values.str.strip()
+        if field == 'IMEI #':
+            values = values.str.lstrip("'")
+        columns[field] = column.expand(values)
+    count_unmatched(picklist_resolver, misses)
+
+    column_ids = [int(column_id) for column_id in column_id_mapping.values()]
+    return [
+        [{'columnId': column_id, 'value': value} for column_id, value in zip(column_ids, values)]
+        for values in zip(*(column.tolist() for column in columns.values()))
+    ]
+
+# Yield (row, cells) for each merged row. With vectorized the cells are prepared with prepare_cells_batch,
+# vectorized_transform.BATCH_SIZE rows at a time.
+def iter_prepared_cells(records, column_id_mapping, picklist_resolver, vectorized=False):
+    if not vectorized:
+        for row in records:
+            yield row, prepare_cells(row, column_id_mapping, picklist_resolver)
+        return
+    for batch in vectorized_transform.batched(records):
+        yield from zip(batch, prepare_cells_batch(batch, column_id_mapping, picklist_resolver))
+
 # Function to get the full path of a file in the same directory as the script
 def get_file_path(filename):
     return os.path.join(os.path.dirname(__file__), filename)
 
-# Function to get all rows from Smartsheet using Smartsheet SDK
-def get_smartsheet_rows(sheet_id, column_id_mapping):
-    sheet = smartsheet_client.Sheets.get_sheet(sheet_id)
-    smartsheet_rows = {}
-    
-    for row in sheet.rows:
-        row_data = {'row_id': row.id}  # Capture the row ID
-        for cell in row.cells:
-            for field, column_id in column_id_mapping.items():
-                if cell.column_id == column_id:
-                    value = str(cell.value) if not isinstance(cell.value, str) else cell.value
-                    row_data[field] = normalize_text(value)
-        imei_value = row_data.get('IMEI #')
-        if imei_value:
-            smartsheet_rows[imei_value] = row_data
-    return smartsheet_rows
-
-# Function to update an existing row in Smartsheet
-def update_smartsheet_row(sheet_id, row_id, cells):
-    new_row = smartsheet.models.Row()
-    new_row.id = row_id
-    for cell in cells:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = cell['columnId']
-        new_cell.value = cell['value']
-        new_cell.type = 'TEXT'  # Ensure cell type is set to text
-        new_row.cells.append(new_cell)
-    updated_row = smartsheet_client.Sheets.update_rows(sheet_id, [new_row])
-    print(f"Updated row {row_id} in Smartsheet")
-    return updated_row
+# Function to convert a Smartsheet cell value to the text written by prepare_cells
+def cell_text(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+# Function to hash the values of a row in column order
+def content_hash(values):
+    return sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+# Function to describe a sheet row (a sheet_cache.SheetRow with values for column_ids) for change detection:
+# its ID, the current cell text keyed by column ID and a content hash of the values in column order
+def row_entry(row, column_ids):
+    current_values = {}
+    for column_id, cell_value in zip(column_ids, row.values):
+        if cell_value is not None:
+            current_values[column_id] = cell_text(cell_value)
+    return {
+        'row_id': row.id,
+        'cells': current_values,
+        'content_hash': content_hash([current_values.get(column_id, '') for column_id in column_ids])
+    }
+
+# Looks rows up by normalized IMEI in the sheet mirror, returning row_entry descriptions of the rows (the last row
+# wins when an IMEI appears more than once) without holding every row in memory
+class MirrorRowLookup:
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def get(self, imei, default=None):
+        row = self.mirror.find_by_key(imei)
+        return default if row is None else row_entry(row, self.mirror.column_ids)
+
+    def __getitem__(self, imei):
+        row_data = self.get(imei)
+        if row_data is None:
+            raise KeyError(imei)
+        return row_data
+
+    def __contains__(self, imei):
+        return self.get(imei) is not None
+
+# Function to compare prepared cells with the current values of a Smartsheet row
+def diff_cells(cells, existing_row):
+    """Return only the cells whose value differs from `existing_row`; an empty list means the row is unchanged."""
+    if content_hash([cell['value'] for cell in cells]) == existing_row['content_hash']:
+        return []
+    current_values = existing_row['cells']
+    return [cell for cell in cells if current_values.get(cell['columnId'], '') != cell['value']]
 
-# Function to add a new row to Smartsheet
-def add_smartsheet_row(sheet_id, cells):
+# Function to build a Smartsheet row model from prepared cells
+def build_row(cells, row_id=None):
     new_row = smartsheet.models.Row()
+    if row_id is not None:
+        new_row.id = row_id
+    else:
+        new_row.to_bottom = True
     for cell in cells:
         new_cell = smartsheet.models.Cell()
         new_cell.column_id = cell['columnId']
         new_cell.value = cell['value']
         new_cell.type = 'TEXT'  # Ensure cell type is set to text
         new_row.cells.append(new_cell)
-    new_row.to_bottom = True
-    added_row = smartsheet_client.Sheets.add_rows(sheet_id, [new_row])
-    print("Added new row to Smartsheet")
-    return added_row
+    return new_row
+
+# Function to split a list into lists of at most `size` items
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# Function to check whether a rejected request certainly left the sheet unchanged: Smartsheet refuses rate-limited
+# (429) and invalid (4xx) requests before applying them, while a server error may come after the rows were written
+def request_rejected(error_result):
+    status_code = getattr(error_result, 'status_code', None)
+    return status_code is not None and 400 <= int(status_code) < 500
+
+# Function to send one chunk of rows with partial success enabled
+def send_row_chunk(sheet_id, action, entries):
+    """Send `entries` as one request and return ({entry index: error} for the rows that failed,
+    {entry index: error} for the rows whose outcome is unknown).
+
+    Updates only set cell values, so repeating one is harmless and every failed update is reported
+    as failed. An add that failed as a whole without being rejected (see request_rejected) may
+    still have inserted the rows, so its rows are reported as unknown rather than failed.
+    """
+    rows = [build_row(entry['cells'], entry['row_id']) for entry in entries]
+    method = 'PUT' if action == 'update' else 'POST'
+    # The SDK sends its own requests, so they are charged to the rate budget here
+    http_client.throttle(f'{smartsheet_api_base_url}/sheets/{sheet_id}/rows')
+    start = time.monotonic()
+    try:
+        if action == 'update':
+            response = smartsheet_client.Sheets.update_rows_with_partial_success(sheet_id, rows)
+        else:
+            response = smartsheet_client.Sheets.add_rows_with_partial_success(sheet_id, rows)
+    except smartsheet.exceptions.ApiError as e:
+        metrics.observe_request(method, f'/sheets/{sheet_id}/rows', 'error', time.monotonic() - start)
+        return chunk_error(action, len(entries), str(e), getattr(e.error, 'result', None))
+    metrics.observe_request(
+        method, f'/sheets/{sheet_id}/rows',
+        'error' if isinstance(response, smartsheet.models.Error) else 200, time.monotonic() - start
+    )
+
+    # Without errors_as_exceptions the SDK returns an Error model for a rejected request
+    if isinstance(response, smartsheet.models.Error):
+        message = getattr(response.result, 'message', None) or 'Request failed'
+        return chunk_error(action, len(entries), message, response.result)
+
+    failures = {}
+    for failed_item in getattr(response, 'failed_items', None) or []:
+        message = getattr(failed_item.error, 'message', None) or 'Row rejected'
+        failures[int(failed_item.index)] = message
+
+    # Successful rows come back in request order, which gives added rows their new IDs
+    succeeded = [index for index in range(len(entries)) if index not in failures]
+    for index, row in zip(succeeded, response.result or []):
+        if entries[index]['row_id'] is None:
+            entries[index]['new_row_id'] = row.id
+    return failures, {}
+
+# Function to report an error for a whole chunk as (failures, unknown), see send_row_chunk
+def chunk_error(action, count, message, error_result):
+    errors = {index: message for index in range(count)}
+    if action == 'add' and not request_rejected(error_result):
+        return {}, {index: f"Outcome unknown, not re-sent: {message}" for index in errors}
+    return errors, {}
+
+# Function to add and update rows in bounded chunks; the rows that failed are gathered and re-sent together,
+# in chunks again, while rows that succeeded, or whose add may have gone through, are not sent a second time
+def upsert_rows(sheet_id, entries, chunk_size=BULK_CHUNK_SIZE, max_attempts=BULK_MAX_ATTEMPTS):
+    """Write `entries` (dicts with 'imei', 'cells' and 'row_id', None for new rows) and return a per-row report."""
+    report = []
+    for action in ('update', 'add'):
+        pending = [entry for entry in entries if (entry['row_id'] is None) == (action == 'add')]
+        attempts = 0
+        errors = {}
+        while pending and attempts < max_attempts:
+            attempts += 1
+            retry = []
+            for chunk in chunked(pending, chunk_size):
+                failures, unknown = send_row_chunk(sheet_id, action, chunk)
+                for index, entry in enumerate(chunk):
+                    if index in unknown:
+                        report.append({
+                            'imei': entry['imei'],
+                            'action': action,
+                            'row_id': entry['row_id'],
+                            'status': 'failed',
+                            'attempts': attempts,
+                            'error': unknown[index]
+                        })
+                    elif index in failures:
+                        errors[id(entry)] = failures[index]
+                        retry.append(entry)
+                    else:
+                        report.append({
+                            'imei': entry['imei'],
+                            'action': action,
+                            'row_id': entry['row_id'] if action == 'update' else entry.get('new_row_id'),
+                            'status': 'ok',
+                            'attempts': attempts,
+                            'error': None
+                        })
+            if retry:
+                print(f"{len(retry)} row(s) failed to {action} on attempt {attempts}")
+            pending = retry
+
+        for entry in pending:
+            report.append({
+                'imei': entry['imei'],
+                'action': action,
+                'row_id': entry['row_id'],
+                'status': 'failed',
+                'attempts': attempts,
+                'error': errors.get(id(entry))
+            })
+    return report
+
+# Function to process merged devices as they arrive, from the CSV or streamed from the merge stage
+def process_records(records, column_id_mapping, picklist_resolver, smartsheet_data, vectorized=False):
+    entries = []
+    updates_by_row_id = {}  # A row merged more than once is sent once, with its latest values
+    unchanged = 0
+    processed = 0
+    for row, cells in iter_prepared_cells(records, column_id_mapping, picklist_resolver, vectorized):
+        processed += 1
+        imei = normalize_text(row.get('IMEI #'))
+        # Ensure no leading apostrophe in IMEI value
+        imei = imei.lstrip("'")
+        
+        logging.debug("Processing IMEI: %s with Cells: %s", imei, cells)
+        
+        existing_row = smartsheet_data.get(imei)
+        if existing_row is not None:
+            row_id = existing_row['row_id']
+            changed_cells = diff_cells(cells, existing_row)
+            if not changed_cells:
+                # The latest version matches the sheet, so an earlier version of the row must not be sent either
+                updates_by_row_id.pop(row_id, None)
+                unchanged += 1
+                continue
+            if row_id in updates_by_row_id:
+                updates_by_row_id[row_id]['cells'] = changed_cells
+                continue
+            entry = {'imei': imei, 'cells': changed_cells, 'row_id': row_id}
+            updates_by_row_id[row_id] = entry
+            entries.append(entry)
+        else:
+            entries.append({'imei': imei, 'cells': cells, 'row_id': None})
+
+    # Leave out the updates dropped above
+    entries = [entry for entry in entries if entry['row_id'] is None or updates_by_row_id.get(entry['row_id']) is entry]
+
+    print(f"Skipped {unchanged} unchanged rows")
+    metrics.increment('smartsheet_picklist_unmatched', picklist_resolver.report_unmatched())
+    report = upsert_rows(smartsheet_sheet_id, entries)
+    if entries:
+        sheet_cache.invalidate(smartsheet_sheet_id)  # The cached sheet no longer reflects our writes
+
+    updated = sum(1 for result in report if result['status'] == 'ok' and result['action'] == 'update')
+    added = sum(1 for result in report if result['status'] == 'ok' and result['action'] == 'add')
+    print(f"Updated {updated} rows and added {added} rows in Smartsheet")
+    metrics.increment('smartsheet_rows_processed', processed)
+    metrics.increment('smartsheet_rows_skipped', unchanged)
+    metrics.increment('smartsheet_rows_updated', updated)
+    metrics.increment('smartsheet_rows_added', added)
+    metrics.increment('smartsheet_rows_failed', len(report) - updated - added)
+    for result in report:
+        if result['status'] == 'failed':
+            print(f"Failed to {result['action']} IMEI {result['imei']}: {result['error']}")
+    return report
 
 # Function to read CSV and process rows
-def read_csv_and_process(file_path, column_id_mapping, picklist_options_mapping, smartsheet_data):
+def read_csv_and_process(file_path, column_id_mapping, picklist_resolver, smartsheet_data, vectorized=False):
     with open(file_path, mode='r') as file:
         reader = csv.DictReader(file)
-        for row in reader:
-            imei = normalize_text(row.get('IMEI #'))
-            # Ensure no leading apostrophe in IMEI value
-            imei = imei.lstrip("'")
-            cells = prepare_cells(row, column_id_mapping, picklist_options_mapping)
-            
-            print(f"Processing IMEI: {imei} with Cells: {cells}")
-            
-            if imei in smartsheet_data:
-                update_smartsheet_row(smartsheet_sheet_id, smartsheet_data[imei]['row_id'], cells)
-            else:
-                add_smartsheet_row(smartsheet_sheet_id, cells)
-
-# Main function to process the data
-def process_data():
+        return process_records(iter_devices(reader), column_id_mapping, picklist_resolver, smartsheet_data, vectorized)
+
+# Main function to process the data; merged rows passed in memory are used instead of the CSV file.
+# A mirror passed in (e.g. the one sync_daemon.py keeps open) is used as it is and left open. With vectorized the
+# cells are prepared column-wise (see prepare_cells_batch).
+def process_data(records=None, mirror=None, vectorized=False):
     # Dynamically retrieve column IDs and picklist options
     column_id_mapping, picklist_options_mapping = get_column_ids_and_picklists(smartsheet_sheet_id)
     
     # Print picklist options mapping
-    print("Picklist Options Mapping:", picklist_options_mapping)
+    logging.debug("Picklist Options Mapping: %s", picklist_options_mapping)
+    picklist_resolver = build_picklist_resolver(picklist_options_mapping)
     
-    # Get all Smartsheet rows
-    smartsheet_data = get_smartsheet_rows(smartsheet_sheet_id, column_id_mapping)
-    
-    smartsheet_csv_file = get_file_path(csv_file_names['smartsheet_data'])
-    
-    # Read CSV and process data
-    read_csv_and_process(smartsheet_csv_file, column_id_mapping, picklist_options_mapping, smartsheet_data)
+    # Look existing rows up in the sheet mirror, which only downloads rows modified since it was last synced.
+    # Its columns come from the same column definitions, so entries hash the values in the same order.
+    owns_mirror = mirror is None
+    if owns_mirror:
+        mirror = open_mirror(smartsheet_sheet_id)
+    try:
+        smartsheet_data = MirrorRowLookup(mirror)
+
+        if records is not None:
+            return process_records(records, column_id_mapping, picklist_resolver, smartsheet_data, vectorized)
+
+        smartsheet_csv_file = get_file_path(csv_file_names['smartsheet_data'])
+
+        # Read CSV and process data
+        return read_csv_and_process(smartsheet_csv_file, column_id_mapping, picklist_resolver, smartsheet_data, vectorized)
+    finally:
+        if owns_mirror:
+            mirror.close()
 
 if __name__ == "__main__":
     process_data()
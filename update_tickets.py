@@ -1,44 +1,237 @@
 import requests
+import http_client
+import metrics
 import csv
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from credentials import zendesk_subdomain, zendesk_email, zendesk_api_token, WAITING_QUEUE_ID
+from json_state import load_json_file
+from comment_ledger import CommentLedger
+from device import iter_devices
 
-# Base URL for Zendesk API
-ZENDESK_BASE_URL = f'https://{zendesk_subdomain}.zendesk.com/api/v2'
+# Base URL for Zendesk API (ZENDESK_BASE_URL in the environment points the script at another server, e.g. a local fake)
+ZENDESK_BASE_URL = os.environ.get('ZENDESK_BASE_URL', f'https://{zendesk_subdomain}.zendesk.com/api/v2')
 
 # Authentication for Zendesk API
 zendesk_auth = (f'{zendesk_email}/token', zendesk_api_token)
 
+# Number of tickets processed concurrently
+TICKET_WORKERS = 8
+
+# Ticket snapshot saved by zendesk_data; its statuses are trusted if it was saved less than this many seconds ago
+TICKET_SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zendesk_ticket_snapshot.json')
+SNAPSHOT_MAX_AGE = 5 * 60
+
+# Maximum number of IDs the show_many endpoint accepts per request
+SHOW_MANY_CHUNK_SIZE = 100
+
+# Maximum number of tickets the update_many endpoint accepts per job
+BULK_UPDATE_CHUNK_SIZE = 100
+
+# Number of times a ticket is submitted in a bulk update before it is reported as failed
+BULK_UPDATE_ATTEMPTS = 3
+
+# Seconds between job status polls, and the longest the jobs of one attempt are waited for
+JOB_POLL_INTERVAL = 1
+JOB_TIMEOUT = 5 * 60
+
+# Job statuses after which a job's results are final
+JOB_FINISHED_STATUSES = {'completed', 'failed', 'killed'}
+
 def get_ticket_status(ticket_id):
     url = f'{ZENDESK_BASE_URL}/tickets/{ticket_id}.json'
-    response = requests.get(url, auth=zendesk_auth)
+    response = http_client.get(url, auth=zendesk_auth)
     response.raise_for_status()
     ticket = response.json()['ticket']
     return ticket['status']
 
+# Read ticket statuses from the ingestion snapshot if it is fresh enough
+def get_snapshot_statuses(max_age=SNAPSHOT_MAX_AGE):
+    snapshot = load_json_file(TICKET_SNAPSHOT_FILE, {})
+    if time.time() - snapshot.get('saved_at', 0) > max_age:
+        return {}
+    return {
+        str(ticket_id): ticket['status']
+        for ticket_id, ticket in snapshot.get('tickets', {}).items()
+        if ticket.get('status')
+    }
+
+# Look up ticket statuses with the show_many endpoint, SHOW_MANY_CHUNK_SIZE IDs per request
+def fetch_ticket_statuses(ticket_ids):
+    statuses = {}
+    ticket_ids = list(ticket_ids)
+    for start in range(0, len(ticket_ids), SHOW_MANY_CHUNK_SIZE):
+        chunk = ticket_ids[start:start + SHOW_MANY_CHUNK_SIZE]
+        url = f"{ZENDESK_BASE_URL}/tickets/show_many.json?ids={','.join(str(ticket_id) for ticket_id in chunk)}"
+        response = http_client.get(url, auth=zendesk_auth)
+        response.raise_for_status()
+        for ticket in response.json().get('tickets', []):
+            statuses[str(ticket['id'])] = ticket['status']
+    return statuses
+
+# Resolve the status of every ticket, reusing the snapshot and batching the rest
+def get_ticket_statuses(ticket_ids):
+    statuses = {}
+    snapshot_statuses = get_snapshot_statuses()
+    missing = []
+    for ticket_id in ticket_ids:
+        if str(ticket_id) in snapshot_statuses:
+            statuses[str(ticket_id)] = snapshot_statuses[str(ticket_id)]
+        else:
+            missing.append(ticket_id)
+    if missing:
+        statuses.update(fetch_ticket_statuses(missing))
+    return statuses
+
 def get_ticket_comments(ticket_id):
+    comments = []
     url = f'{ZENDESK_BASE_URL}/tickets/{ticket_id}/comments.json'
-    response = requests.get(url, auth=zendesk_auth)
-    response.raise_for_status()
-    comments = response.json()['comments']
+    while url:
+        response = http_client.get(url, auth=zendesk_auth)
+        response.raise_for_status()
+        data = response.json()
+        comments.extend(data['comments'])
+        url = data.get('next_page')  # Follow pagination on long-lived tickets
     return comments
 
+# The change every updated ticket gets: a private comment and a move to the waiting queue
+def ticket_changes(comment_body):
+    return {
+        'comment': {
+            'body': comment_body,
+            'public': False  # Make this comment private
+        },
+        'group_id': WAITING_QUEUE_ID  # Move the ticket to the waiting queue
+    }
+
 def update_ticket(ticket_id, comment_body):
     url = f'{ZENDESK_BASE_URL}/tickets/{ticket_id}.json'
-    data = {
-        'ticket': {
-            'comment': {
-                'body': comment_body,
-                'public': False  # Make this comment private
-            },
-            'group_id': WAITING_QUEUE_ID  # Move the ticket to the waiting queue
-        }
-    }
-    response = requests.put(url, json=data, auth=zendesk_auth)
+    response = http_client.put(url, json={'ticket': ticket_changes(comment_body)}, auth=zendesk_auth)
     response.raise_for_status()
     print(f"Updated ticket {ticket_id} and moved to waiting queue {WAITING_QUEUE_ID}")
 
+# Submit one update_many job for a chunk of {ticket ID: comment body} and return the job ID
+def submit_bulk_update(updates):
+    url = f'{ZENDESK_BASE_URL}/tickets/update_many.json'
+    tickets = [
+        dict(ticket_changes(comment_body), id=int(ticket_id) if str(ticket_id).isdigit() else ticket_id)
+        for ticket_id, comment_body in updates.items()
+    ]
+    # Not retried by http_client: a job whose response was lost may have been queued, and is judged by the caller
+    response = http_client.put(url, json={'tickets': tickets}, auth=zendesk_auth, max_retries=0)
+    response.raise_for_status()
+    return response.json()['job_status']['id']
+
+# Check whether a failed submission certainly did not queue a job: the connection could not be opened, or
+# Zendesk rejected it with 429. Any other error (read timeout, server error, unreadable response) leaves the
+# outcome unknown.
+def submission_rejected(error):
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code == http_client.RATE_LIMIT_STATUS
+    return http_client.request_not_sent(error)
+
+# Poll the job statuses, SHOW_MANY_CHUNK_SIZE jobs per request, until every job has finished or the timeout
+# passes. Returns {job ID: job status} for the finished jobs.
+def wait_for_jobs(job_ids, poll_interval=JOB_POLL_INTERVAL, timeout=JOB_TIMEOUT):
+    finished = {}
+    pending = list(job_ids)
+    deadline = time.monotonic() + timeout
+    while pending:
+        for start in range(0, len(pending), SHOW_MANY_CHUNK_SIZE):
+            chunk = pending[start:start + SHOW_MANY_CHUNK_SIZE]
+            url = f"{ZENDESK_BASE_URL}/job_statuses/show_many.json?ids={','.join(chunk)}"
+            response = http_client.get(url, auth=zendesk_auth)
+            response.raise_for_status()
+            for job in response.json().get('job_statuses', []):
+                if job.get('status') in JOB_FINISHED_STATUSES:
+                    finished[job['id']] = job
+        pending = [job_id for job_id in pending if job_id not in finished]
+        if pending:
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(poll_interval)
+    return finished
+
+# Map the results of a finished job back to its tickets. Returns ({ticket ID: error} for the tickets the job
+# reports as failed, {ticket ID: error} for the tickets it has no result for). A failed or killed job may have
+# updated a ticket it has no result for, so the outcome of those is unknown.
+def job_failures(job, ticket_ids):
+    results = {str(result.get('id')): result for result in job.get('results') or []}
+    failures = {}
+    unknown = {}
+    for ticket_id in ticket_ids:
+        result = results.get(str(ticket_id))
+        if result is None:
+            unknown[ticket_id] = f"Bulk update outcome unknown: no result for the ticket in job {job['id']} ({job.get('status')})"
+        elif result.get('success') is False or result.get('error') or result.get('errors'):
+            failures[ticket_id] = str(result.get('details') or result.get('errors') or result.get('error'))
+    return failures, unknown
+
+def bulk_update_tickets(updates, chunk_size=BULK_UPDATE_CHUNK_SIZE, max_attempts=BULK_UPDATE_ATTEMPTS):
+    """Comment on and move the tickets in `updates` (ticket ID -> comment body) through update_many jobs.
+
+    Tickets a job reports as failed, or whose submission was certainly rejected, are submitted
+    again, up to max_attempts times. Returns {ticket ID: error or None}. Tickets whose job never
+    finished or has no result for them, or whose submission may have queued a job, are not
+    resubmitted, since their comment may already have been posted.
+    """
+    outcome = {}
+    pending = dict(updates)
+    attempts = 0
+    while pending and attempts < max_attempts:
+        attempts += 1
+        jobs = {}  # Job ID -> IDs of the tickets in the job
+        failures = {}
+        rejected = False
+        items = list(pending.items())
+        for start in range(0, len(items), chunk_size):
+            chunk = dict(items[start:start + chunk_size])
+            try:
+                jobs[submit_bulk_update(chunk)] = list(chunk)
+            except requests.RequestException as e:
+                if submission_rejected(e):
+                    rejected = True
+                    failures.update((ticket_id, str(e)) for ticket_id in chunk)
+                else:
+                    for ticket_id in chunk:
+                        outcome[ticket_id] = f"Bulk update outcome unknown: {e}"
+                        pending.pop(ticket_id)
+
+        try:
+            finished = wait_for_jobs(jobs)
+        except requests.RequestException as e:
+            print(f"Could not poll the bulk update jobs: {e}")
+            finished = {}
+        for job_id, ticket_ids in jobs.items():
+            job = finished.get(job_id)
+            if job is None:
+                for ticket_id in ticket_ids:
+                    outcome[ticket_id] = f"Bulk update job {job_id} did not finish"
+                    pending.pop(ticket_id)
+            else:
+                job_failed, job_unknown = job_failures(job, ticket_ids)
+                failures.update(job_failed)
+                for ticket_id, error in job_unknown.items():
+                    outcome[ticket_id] = error
+                    pending.pop(ticket_id)
+
+        for ticket_id in pending:
+            if ticket_id not in failures:
+                outcome[ticket_id] = None
+        print(f"Bulk updated {len(pending) - len(failures)} tickets in {len(jobs)} job(s) on attempt {attempts}")
+        if failures:
+            print(f"{len(failures)} ticket(s) failed to update on attempt {attempts}")
+        outcome.update(failures)
+        pending = {ticket_id: pending[ticket_id] for ticket_id in failures}
+        # Submissions are not retried by http_client, so back off here before sending rejected chunks again
+        if rejected and pending and attempts < max_attempts:
+            time.sleep(http_client.backoff_delay(attempts))
+    return outcome
+
 def normalize_text(text):
     return text.strip().replace('\n', ' ').replace('\r', '')
 
@@ -46,68 +239,182 @@ def hash_comment(comment_body):
     """Create a hash for the comment body to ensure uniqueness"""
     return sha256(normalize_text(comment_body).encode('utf-8')).hexdigest()
 
-def comment_already_exists(comments, comment_body):
-    """Check if a comment with the same body already exists"""
-    normalized_body = normalize_text(comment_body)
-    body_hash = hash_comment(normalized_body)
-    return any(hash_comment(normalize_text(comment['body'])) == body_hash for comment in comments)
-
 def construct_comment_body(rows):
-    comment_body = "Form Data:\n"
+    blocks = []
 
-    for row in rows:
-        imei = normalize_text(row['IMEI #'])
-        comment_body += (
+    for device in rows:
+        imei = normalize_text(device.imei)
+        blocks.append(
             f"IMEI #: {imei}\n"
-            f"Serial # Apple Only: {row['Serial # Apple only']}\n"
-            f"Brand: {row['Brand']}\n"
-            f"Model: {row['Model']}\n"
-            f"Status: {row['Status']}\n"
-            f"Deploy Date: {row['Deploy Date']}\n"
-            f"Fulfilled By: {row['Fulfilled By']}\n"
-            f"GL Code - Facility Name: {row['GL Code - Facility Name']}\n"
-            f"Recipient: {row['Recipient']}\n"
-            f"Notes: {row['Notes']}\n\n"
+            f"Serial # Apple Only: {device.serial}\n"
+            f"Brand: {device.brand}\n"
+            f"Model: {device.model}\n"
+            f"Status: {device.status}\n"
+            f"Deploy Date: {device.deploy_date}\n"
+            f"Fulfilled By: {device.fulfilled_by}\n"
+            f"GL Code - Facility Name: {device.gl_code}\n"
+            f"Recipient: {device.recipient}\n"
+            f"Notes: {device.notes}"
         )
     
-    return comment_body.strip()
+    # Same text as the previous concatenation, so hashes of comments posted earlier still match
+    return ("Form Data:\n" + "\n\n".join(blocks)).strip()
 
-def main():
-    # Path to the CSV file relative to the script's directory
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    csv_file_path = os.path.join(script_dir, 'zendesk_tickets.csv')
-
-    # Read the CSV file
+# Group Zendesk rows by ticket ID as devices
+def group_rows_by_ticket(rows):
     tickets_data = {}
+    for device in iter_devices(rows):
+        ticket_id = device.ticket
+        if ticket_id:
+            if ticket_id not in tickets_data:
+                tickets_data[ticket_id] = []
+            tickets_data[ticket_id].append(device)
+    return tickets_data
+
+# Read the Zendesk CSV and group its rows by ticket ID
+def load_tickets_data(csv_file_path):
     with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            ticket_id = row['Ticket #']
-            if ticket_id:
-                if ticket_id not in tickets_data:
-                    tickets_data[ticket_id] = []
-                tickets_data[ticket_id].append(row)
-
-    # Process each ticket
-    for ticket_id, rows in tickets_data.items():
-        # Check ticket status
-        status = get_ticket_status(ticket_id)
-        if status.lower() != 'closed':
-            # Construct the comment body from all rows for this ticket
-            comment_body = construct_comment_body(rows)
-
-            # Get existing comments for the ticket
+        return group_rows_by_ticket(csv.DictReader(csvfile))
+
+# Check and compare a single ticket, returning the outcome instead of printing it. A ticket that needs the
+# comment comes back as 'pending', with the comment body and its hash.
+def check_ticket(ticket_id, rows, status=None, ledger=None, reconcile=False):
+    try:
+        # Check ticket status, unless it was already resolved in bulk
+        if status is None:
+            status = get_ticket_status(ticket_id)
+        if status.lower() == 'closed':
+            return {'ticket_id': ticket_id, 'result': 'closed', 'error': None}
+
+        # Construct the comment body from all rows for this ticket
+        comment_body = construct_comment_body(rows)
+        body_hash = hash_comment(comment_body)
+
+        if ledger is not None and not reconcile and ledger.has_ticket(ticket_id):
+            # The ledger already knows this ticket's comments, so no download is needed
+            if ledger.has_comment(ticket_id, body_hash):
+                return {'ticket_id': ticket_id, 'result': 'exists', 'error': None}
+        else:
+            # Get existing comments for the ticket and remember their hashes
             comments = get_ticket_comments(ticket_id)
+            comment_hashes = {hash_comment(comment['body']) for comment in comments}
+            if ledger is not None:
+                ledger.record(ticket_id, comment_hashes)
 
             # Check if the comment already exists
-            if not comment_already_exists(comments, comment_body):
-                # Update the ticket with the comment and move it to the waiting queue
-                update_ticket(ticket_id, comment_body)
-                print(f"Ticket {ticket_id} comments were updated.")
+            if body_hash in comment_hashes:
+                return {'ticket_id': ticket_id, 'result': 'exists', 'error': None}
+
+        return {'ticket_id': ticket_id, 'result': 'pending', 'error': None, 'comment_body': comment_body, 'body_hash': body_hash}
+    except requests.RequestException as e:
+        return {'ticket_id': ticket_id, 'result': 'error', 'error': str(e)}
+
+# Check, compare and update a single ticket, returning the outcome instead of printing it
+def process_ticket(ticket_id, rows, status=None, ledger=None, reconcile=False):
+    result = check_ticket(ticket_id, rows, status, ledger, reconcile)
+    if result['result'] != 'pending':
+        return result
+    try:
+        # Update the ticket with the comment and move it to the waiting queue
+        update_ticket(ticket_id, result['comment_body'])
+        if ledger is not None:
+            ledger.record(ticket_id, [result['body_hash']])
+        return {'ticket_id': ticket_id, 'result': 'updated', 'error': None}
+    except requests.RequestException as e:
+        # The comment may have been posted anyway, so the next check reads the ticket's comments again
+        if ledger is not None:
+            ledger.forget(ticket_id)
+        return {'ticket_id': ticket_id, 'result': 'error', 'error': str(e)}
+
+# Send the pending updates of checked tickets through bulk_update_tickets and turn them into 'updated' or 'error'
+def apply_bulk_updates(results, ledger=None):
+    pending = [result for result in results if result['result'] == 'pending']
+    if not pending:
+        return results
+    outcome = bulk_update_tickets({result['ticket_id']: result['comment_body'] for result in pending})
+    for result in pending:
+        error = outcome.get(result['ticket_id'])
+        if ledger is not None:
+            if error is None:
+                ledger.record(result['ticket_id'], [result['body_hash']])
             else:
-                print(f"Comment already exists for ticket {ticket_id}.")
-        else:
+                # The comment may have been posted anyway, so the next check reads the ticket's comments again
+                ledger.forget(result['ticket_id'])
+        result['result'] = 'updated' if error is None else 'error'
+        result['error'] = error
+        del result['comment_body'], result['body_hash']
+    print(f"Moved {sum(1 for result in pending if result['error'] is None)} tickets to waiting queue {WAITING_QUEUE_ID}")
+    return results
+
+# Sort key that orders numeric ticket IDs numerically
+def ticket_sort_key(ticket_id):
+    return (0, int(ticket_id), '') if str(ticket_id).isdigit() else (1, 0, str(ticket_id))
+
+# Process tickets on a bounded pool of workers and return the results ordered by ticket ID. With bulk, the
+# tickets are checked on the pool and the updates are sent together through update_many; otherwise each
+# worker updates its ticket with its own request.
+def process_tickets(tickets_data, max_workers=TICKET_WORKERS, ledger=None, reconcile=False, bulk=True):
+    # Tickets missing from the bulk lookup fall back to a single GET in process_ticket
+    try:
+        statuses = get_ticket_statuses(tickets_data.keys())
+    except requests.RequestException as e:
+        print(f"Bulk status lookup failed, checking tickets individually: {e}")
+        statuses = {}
+
+    handle_ticket = check_ticket if bulk else process_ticket
+
+    def run(item):
+        ticket_id, rows = item
+        return handle_ticket(ticket_id, rows, statuses.get(str(ticket_id)), ledger, reconcile)
+
+    if max_workers <= 1:
+        results = [run(item) for item in tickets_data.items()]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run, tickets_data.items()))
+    if bulk:
+        apply_bulk_updates(results, ledger)
+    return sorted(results, key=lambda result: ticket_sort_key(result['ticket_id']))
+
+def report_results(results):
+    for result in results:
+        ticket_id = result['ticket_id']
+        if result['result'] == 'updated':
+            print(f"Ticket {ticket_id} comments were updated.")
+        elif result['result'] == 'exists':
+            print(f"Comment already exists for ticket {ticket_id}.")
+        elif result['result'] == 'closed':
             print(f"Ticket {ticket_id} is closed and will not be updated.")
+        else:
+            print(f"Ticket {ticket_id} could not be processed: {result['error']}")
+
+def main(max_workers=TICKET_WORKERS, reconcile=False, rows=None, bulk=True):
+    if rows is not None:
+        # Rows passed in memory by the pipeline
+        tickets_data = group_rows_by_ticket(rows)
+    else:
+        # Path to the CSV file relative to the script's directory
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        csv_file_path = os.path.join(script_dir, 'zendesk_tickets.csv')
+
+        # Read the CSV file
+        tickets_data = load_tickets_data(csv_file_path)
+
+    # Process each ticket, checking duplicates against the local comment ledger
+    ledger = CommentLedger()
+    try:
+        results = process_tickets(tickets_data, max_workers=max_workers, ledger=ledger, reconcile=reconcile, bulk=bulk)
+    finally:
+        ledger.close()
+    report_results(results)
+    for result in results:
+        metrics.increment(f"tickets_{result['result']}")
+
+    # Fail the run like a raised request error would, after every ticket has had its chance
+    failed = [result['ticket_id'] for result in results if result['result'] == 'error']
+    if failed:
+        raise RuntimeError(f"Failed to process {len(failed)} ticket(s): {', '.join(failed)}")
+    return results
 
 if __name__ == '__main__':
-    main()
+    main(reconcile='--reconcile' in sys.argv, bulk='--no-bulk' not in sys.argv)
@@ -0,0 +1,108 @@
+"""Column-wise versions of the per-cell transforms, using pandas.
+
+The merge (smartsheet_to_csv.merge_values) and the upsert
+(update_smartsheet.prepare_cells) clean every value in Python, one row at a
+time. The helpers here let them take a batch of rows as a DataFrame and
+apply the same rules a column at a time instead: each column is factorized,
+the rules run once per distinct value with pandas string methods, and the
+results are spread back over the rows. Inventory columns hold few distinct
+values (brands, models, statuses, dates), so this does far less work on
+large inputs while giving exactly the same output, down to the unmatched
+picklist values counted by the PicklistResolver.
+
+pandas is optional. Without it available() is False and the callers keep
+using the row-wise functions.
+"""
+import logging
+from device import SPECIAL_CHARACTERS
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+# Rows put in one DataFrame; larger inputs are transformed a batch at a time so memory stays bounded
+BATCH_SIZE = 10000
+
+
+def available():
+    return pd is not None
+
+# Whether to use the vectorized transforms when they are requested, warning if pandas is missing
+def use_vectorized(requested):
+    if requested and not available():
+        logging.warning("pandas is not installed, using the row-wise transforms")
+    return bool(requested) and available()
+
+# Yield lists of up to size records from a stream
+def batched(records, size=BATCH_SIZE):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# DataFrame of the given columns of a batch of rows (dicts or devices), missing values as ''. Columns keep the
+# Python strings (object dtype), so the string methods behave exactly like str's.
+def rows_frame(rows, columns):
+    return pd.DataFrame({column: [row.get(column, '') for row in rows] for column in columns}, dtype=object)
+
+# Rows of {title: transformed column} as a list of dicts keyed by title
+def column_records(columns):
+    titles = list(columns)
+    return [dict(zip(titles, values)) for values in zip(*(column.tolist() for column in columns.values()))]
+
+
+class DistinctColumn:
+    """A DataFrame column split into its distinct values and a code per row pointing at one of them."""
+
+    def __init__(self, column):
+        self.index = column.index
+        self.codes, distinct = pd.factorize(column.to_numpy(dtype=object), use_na_sentinel=False)
+        self.values = pd.Series(distinct, dtype=object)
+
+    # Number of rows holding each distinct value
+    def counts(self):
+        return np.bincount(self.codes, minlength=len(self.values))
+
+    # Position of the first row holding each distinct value
+    def first_rows(self):
+        return np.unique(self.codes, return_index=True)[1]
+
+    # Column with the result for each distinct value put back on every row holding it
+    def expand(self, results):
+        return pd.Series(np.asarray(results, dtype=object)[self.codes], index=self.index)
+
+
+# device.normalized_key for a Series of strings, with the same steps done by pandas string methods
+def normalized_keys(values):
+    keys = values.str.replace(SPECIAL_CHARACTERS, '', regex=True).str.split().str.join(' ').str.strip().str.upper()
+    return keys.str.removeprefix("'")
+
+# Canonical picklist option for each value of `values` (distinct values of column, as they are looked up), or None,
+# the same as PicklistResolver.lookup. Each miss lookup() would have counted is appended to misses as
+# (first row, position, (field name, stripped value), rows) for count_unmatched.
+def lookup_options(column, values, field_name, picklist_resolver, position, misses):
+    options = picklist_resolver.options_by_field.get(field_name)
+    if not options:
+        return pd.Series([None] * len(values), index=values.index, dtype=object)
+    found = pd.Series([options.get(picklist_resolver.normalizer(value)) for value in values], index=values.index, dtype=object)
+
+    stripped = values.str.strip()
+    missed = found.isna() & (stripped != '')
+    if missed.any():
+        counts = column.counts()
+        first_rows = column.first_rows()
+        for index in missed[missed].index:
+            misses.append((first_rows[index], position, (field_name, stripped[index]), int(counts[index])))
+    return found
+
+# Add the misses of a batch to the resolver's counts in the order lookup() would have met them (row by row, and
+# column by column within a row), so report_unmatched lists them the same way as after a row-wise pass
+def count_unmatched(picklist_resolver, misses):
+    for _, _, key, count in sorted(misses, key=lambda miss: miss[:2]):
+        picklist_resolver.unmatched[key] += count
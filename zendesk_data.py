@@ -1,167 +1,374 @@
 import requests
-import csv
+import http_client
 import os
+import sys
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from record_stream import write_csv
+from json_state import load_json_file, save_json_file
+from device import COLUMNS, Device
 from credentials import zendesk_subdomain, zendesk_email, zendesk_api_token, FORM_ID, QUEUE_ID, WAITING_QUEUE_ID
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging; LOG_LEVEL=DEBUG in the environment turns on the per-row and raw response output
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Base URL for Zendesk API
-ZENDESK_BASE_URL = f'https://{zendesk_subdomain}.zendesk.com/api/v2'
+# Base URL for Zendesk API (ZENDESK_BASE_URL in the environment points the script at another server, e.g. a local fake)
+ZENDESK_BASE_URL = os.environ.get('ZENDESK_BASE_URL', f'https://{zendesk_subdomain}.zendesk.com/api/v2')
 
 # Authentication for Zendesk API
 zendesk_auth = (f'{zendesk_email}/token', zendesk_api_token)
 
-# Fetch all ticket fields and their IDs from Zendesk
-def fetch_ticket_fields():
+# Files that persist the incremental export cursor and the last ticket snapshot between runs
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SYNC_STATE_FILE = os.path.join(SCRIPT_DIR, 'zendesk_sync_state.json')
+TICKET_SNAPSHOT_FILE = os.path.join(SCRIPT_DIR, 'zendesk_ticket_snapshot.json')
+
+# File caching the ticket fields and dropdown options, revalidated with the ticket fields ETag and updated_at
+FIELD_METADATA_FILE = os.path.join(SCRIPT_DIR, 'zendesk_field_metadata.json')
+
+# Dropdown fields whose options map tags to names, and how many option lists are fetched at once
+DROPDOWN_FIELDS = ['Brand', 'Model', 'Status', 'Fulfilled By', 'GL Code - Facility Name', 'Notes']
+METADATA_WORKERS = 6
+
+# Ticket attributes kept in the snapshot besides the custom fields (update_tickets reads the status from it)
+TICKET_KEYS = ('id', 'status', 'group_id', 'ticket_form_id', 'updated_at')
+
+# Start time (Unix seconds) the bootstrap reads the incremental export from, so it sees every ticket of the account
+BOOTSTRAP_START_TIME = 0
+
+# URL of the next page of a list response, for both offset (next_page) and cursor (links.next) pagination
+def next_page_url(data):
+    if data.get('next_page'):
+        return data['next_page']
+    if data.get('meta', {}).get('has_more'):
+        return data.get('links', {}).get('next')
+    return None
+
+# Fetch every item of a paginated list, starting from an already received first page if given
+def fetch_all_pages(url, key, first_page=None):
+    items = []
+    data = first_page
+    while True:
+        if data is None:
+            response = http_client.get(url, auth=zendesk_auth)
+            response.raise_for_status()
+            data = response.json()
+        items.extend(data.get(key, []))
+        url = next_page_url(data)
+        if not url:
+            return items
+        data = None
+
+# Fetch every option of a dropdown field, raising if Zendesk cannot be read
+def request_dropdown_options(field_id):
+    url = f"{ZENDESK_BASE_URL}/ticket_fields/{field_id}/options.json"
+    options = fetch_all_pages(url, 'custom_field_options')
+    return {
+        'id_to_name': {str(option['id']): option['name'] for option in options},
+        'tag_to_raw_name': {option['value']: option['name'] for option in options}
+    }
+
+# Fetch the options of the given (field name, field ID) pairs concurrently; fields that fail are left out
+def fetch_dropdown_mappings(fields):
+    mappings = {}
+    if not fields:
+        return mappings
+    with ThreadPoolExecutor(max_workers=min(METADATA_WORKERS, len(fields))) as executor:
+        futures = {field_name: executor.submit(request_dropdown_options, field_id) for field_name, field_id in fields}
+        for field_name, future in futures.items():
+            try:
+                mappings[field_name] = future.result()
+                logging.info(f"Fetched {len(mappings[field_name]['id_to_name'])} dropdown options for {field_name}")
+            except requests.RequestException as e:
+                logging.error(f"Error fetching dropdown options for {field_name}: {e}")
+    return mappings
+
+# Load the ticket field IDs and dropdown mappings, reusing the cached copy for whatever has not changed.
+# A warm run costs one conditional request for the ticket fields (every page is read again when there is more
+# than one); option lists are only fetched again for dropdown fields whose updated_at changed.
+def load_field_metadata():
+    cache = load_json_file(FIELD_METADATA_FILE, {})
     url = f"{ZENDESK_BASE_URL}/ticket_fields.json"
+    headers = {'If-None-Match': cache['etag']} if cache.get('etag') and cache.get('field_ids') else {}
+
     try:
-        response = requests.get(url, auth=zendesk_auth)
+        response = http_client.get(url, auth=zendesk_auth, headers=headers)
+        if response.status_code == 304:
+            logging.info("Ticket fields are unchanged, using the cached field metadata")
+            return cache['field_ids'], cache['dropdown_mappings']
         response.raise_for_status()
-        fields = response.json().get('ticket_fields', [])
-        field_ids = {field['title']: field['id'] for field in fields}
-        logging.info(f"Fetched ticket fields: {field_ids}")
-        return field_ids
+        first_page = response.json()
+        # The ETag only covers the first page, so a listing with more pages is not revalidated with it
+        etag = None if next_page_url(first_page) else response.headers.get('ETag')
+        fields = fetch_all_pages(url, 'ticket_fields', first_page=first_page)
     except requests.RequestException as e:
+        if cache.get('field_ids'):
+            logging.warning(f"Error fetching ticket fields, using the cached field metadata: {e}")
+            return cache['field_ids'], cache['dropdown_mappings']
         logging.error(f"Error fetching ticket fields: {e}")
-        return {}
+        return {}, {}
 
-# Fetch options for a dropdown field from Zendesk
-def fetch_dropdown_options(field_id):
-    url = f"{ZENDESK_BASE_URL}/ticket_fields/{field_id}/options.json"
-    try:
-        response = requests.get(url, auth=zendesk_auth)
-        response.raise_for_status()
-        options = response.json().get('custom_field_options', [])
-        return {
-            'id_to_name': {str(option['id']): option['name'] for option in options},
-            'tag_to_raw_name': {option['value']: option['name'] for option in options}
-        }
-    except requests.RequestException as e:
-        logging.error(f"Error fetching dropdown options for field ID {field_id}: {e}")
-        return {'id_to_name': {}, 'tag_to_raw_name': {}}
+    field_ids = {field['title']: field['id'] for field in fields}
+    updated_at = {str(field['id']): field.get('updated_at') for field in fields}
+    cached_updated_at = cache.get('updated_at', {})
+    cached_mappings = cache.get('dropdown_mappings', {})
 
-# Fetch all dropdown field options and return as a dictionary
-def fetch_all_dropdown_mappings(field_ids):
     mappings = {}
-    for field_name in ['Brand', 'Model', 'Status', 'Fulfilled By', 'GL Code - Facility Name', 'Notes']:
+    stale_fields = []
+    for field_name in DROPDOWN_FIELDS:
         field_id = field_ids.get(field_name)
-        if field_id:
-            mappings[field_name] = fetch_dropdown_options(field_id)
-            logging.info(f"Fetched dropdown options for {field_name}: {mappings[field_name]}")
-    return mappings
+        if not field_id:
+            continue
+        field_updated_at = updated_at.get(str(field_id))
+        if field_name in cached_mappings and field_updated_at and cached_updated_at.get(str(field_id)) == field_updated_at:
+            mappings[field_name] = cached_mappings[field_name]
+        else:
+            stale_fields.append((field_name, field_id))
 
-# Fetch tickets from Zendesk for a specific form and group
-def fetch_zendesk_tickets(status=None):
-    tickets = []
-    for queue_id in [QUEUE_ID, WAITING_QUEUE_ID]:
-        url = f"{ZENDESK_BASE_URL}/search.json?query=type:ticket form:{FORM_ID} group:{queue_id}"
-        if status:
-            url += f" status:{status}"
-        
-        logging.info(f"Fetching tickets from URL: {url}")
-
-        while url:
-            try:
-                response = requests.get(url, auth=zendesk_auth)
-                response.raise_for_status()
-                data = response.json()
-                
-                # Log the raw response
-                logging.info(f"Raw response data for queue {queue_id}: {data}")
+    fetched = fetch_dropdown_mappings(stale_fields)
+    mappings.update(fetched)
+    complete = len(fetched) == len(stale_fields)
+    for field_name, _ in stale_fields:
+        mappings.setdefault(field_name, {'id_to_name': {}, 'tag_to_raw_name': {}})
+    logging.info(f"Loaded ticket field metadata ({len(stale_fields)} option lists fetched, {len(mappings) - len(stale_fields)} cached)")
 
-                # Extract and store the tickets
-                results = data.get('results', [])
-                tickets.extend(results)
-                logging.info(f"Fetched {len(results)} tickets from queue {queue_id}")
+    # Only cache complete metadata, so a failed option list is fetched again on the next run
+    if complete:
+        try:
+            save_json_file(FIELD_METADATA_FILE, {
+                'etag': etag, 'field_ids': field_ids, 'updated_at': updated_at, 'dropdown_mappings': mappings
+            })
+        except OSError as e:
+            logging.error(f"Error saving field metadata cache: {e}")
+    return field_ids, mappings
 
-                # Check for pagination
-                url = data.get('next_page')  # Get the URL for the next page if available
+# Yield (changed tickets, cursor) for each page of the incremental export since the given cursor (or start time)
+def iter_incremental_pages(cursor=None, start_time=None):
+    if cursor:
+        url = f"{ZENDESK_BASE_URL}/incremental/tickets/cursor.json?cursor={cursor}"
+    else:
+        url = f"{ZENDESK_BASE_URL}/incremental/tickets/cursor.json?start_time={int(start_time)}"
 
-            except requests.RequestException as e:
-                logging.error(f"Error fetching tickets from queue {queue_id}: {e}")
-                break  # Exit the loop on error
+    while url:
+        response = http_client.get(url, auth=zendesk_auth)
+        response.raise_for_status()
+        data = response.json()
+
+        changed_tickets = data.get('tickets', [])
+        cursor = data.get('after_cursor') or cursor
+        logging.info(f"Fetched {len(changed_tickets)} changed tickets from the incremental export")
+
+        url = None if data.get('end_of_stream') else data.get('after_url')
+        yield changed_tickets, cursor
+
+# Fetch a single ticket, or None if it does not exist (any more)
+def fetch_ticket(ticket_id):
+    response = http_client.get(f"{ZENDESK_BASE_URL}/tickets/{ticket_id}.json", auth=zendesk_auth)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json().get('ticket')
+
+# Check whether a ticket belongs to our form and one of our queues
+def ticket_in_scope(ticket):
+    return (
+        ticket.get('status') != 'deleted'
+        and str(ticket.get('ticket_form_id')) == str(FORM_ID)
+        and str(ticket.get('group_id')) in (str(QUEUE_ID), str(WAITING_QUEUE_ID))
+    )
 
-    return tickets
+# Keep only the parts of a ticket the rows and update_tickets read: its ID, status, form, group and the
+# custom fields in field_keys (all custom fields if None)
+def compact_ticket(ticket, field_keys=None):
+    custom_fields = ticket.get('custom_fields', [])
+    if field_keys is not None:
+        custom_fields = [field for field in custom_fields if str(field.get('id')) in field_keys]
+    compact = {key: ticket[key] for key in TICKET_KEYS if key in ticket}
+    compact['custom_fields'] = custom_fields
+    return compact
+
+# Apply changed tickets to a snapshot keyed by ticket ID, dropping tickets that left our form or queues
+def merge_ticket_changes(snapshot, changed_tickets, field_keys=None):
+    for ticket in changed_tickets:
+        ticket_id = str(ticket.get('id'))
+        if ticket_in_scope(ticket):
+            snapshot[ticket_id] = compact_ticket(ticket, field_keys)
+        else:
+            snapshot.pop(ticket_id, None)
+    return snapshot
+
+# Fetch the current tickets, only asking Zendesk for what changed since the last run. Pages are merged
+# into the snapshot as they arrive, and with field_keys only those custom fields are kept in it.
+def fetch_tickets_incremental(full_refresh=False, field_keys=None):
+    state = load_json_file(SYNC_STATE_FILE, {})
+    saved = load_json_file(TICKET_SNAPSHOT_FILE, {})
+    snapshot = saved.get('tickets', {})
+
+    # A snapshot compacted for other fields lacks values we need now, so it is rebuilt
+    saved_fields = saved.get('fields')
+    missing_fields = field_keys is not None and saved_fields is not None and not set(field_keys) <= set(saved_fields)
+    if missing_fields:
+        logging.info("Ticket fields changed since the snapshot was saved, rebuilding it")
+    elif field_keys is not None and saved_fields is None:
+        # Snapshot saved before tickets were compacted
+        snapshot = {ticket_id: compact_ticket(ticket, field_keys) for ticket_id, ticket in snapshot.items()}
+
+    if full_refresh or missing_fields or not snapshot or not (state.get('cursor') or state.get('start_time')):
+        # Bootstrap by reading the whole incremental export, which has no result cap unlike search, keeping the
+        # tickets in scope; later runs resume from its cursor. A page that cannot be read raises, so a partial
+        # snapshot is never saved with a cursor that would skip the rest.
+        snapshot = {}
+        cursor = None
+        for changed_tickets, cursor in iter_incremental_pages(start_time=BOOTSTRAP_START_TIME):
+            merge_ticket_changes(snapshot, changed_tickets, field_keys)
+        state = {'cursor': cursor}
+        logging.info(f"Bootstrapped ticket snapshot with {len(snapshot)} tickets")
+    else:
+        changed = 0
+        cursor = state.get('cursor')
+        for changed_tickets, cursor in iter_incremental_pages(cursor, state.get('start_time')):
+            merge_ticket_changes(snapshot, changed_tickets, field_keys)
+            changed += len(changed_tickets)
+        state = {'cursor': cursor}
+        logging.info(f"Merged {changed} changed tickets into snapshot of {len(snapshot)} tickets")
+
+    # Persist the snapshot before the cursor so a failed write never skips changes
+    save_json_file(TICKET_SNAPSHOT_FILE, {
+        'saved_at': time.time(), 'fields': sorted(field_keys) if field_keys is not None else None, 'tickets': snapshot
+    })
+    save_json_file(SYNC_STATE_FILE, state)
+    return list(snapshot.values())
+
+# Columns of the Zendesk CSV, in order
+TICKET_FIELDNAMES = COLUMNS
+
+# Columns filled from a dropdown field (option tag -> option name) and from a text field as it is
+TEXT_COLUMNS = ['Serial # Apple only', 'Deploy Date']
+
+# Compile the field lookups for the rows once per run: the custom field key of every column and the
+# tag -> name map of every dropdown column, so building a row is a few dictionary lookups
+def compile_field_plan(field_ids, dropdown_mappings):
+    def key(field_name):
+        return str(field_ids.get(field_name, 'N/A'))
+
+    columns = [(column, key(column), None) for column in TEXT_COLUMNS]
+    columns += [
+        (column, key(column), dropdown_mappings.get(column, {}).get('tag_to_raw_name', {}))
+        for column in DROPDOWN_FIELDS
+    ]
+    return {
+        'imei': key('IMEI #'),
+        'recipient': key('Recipient'),
+        'columns': columns,
+        'field_keys': {key('IMEI #'), key('Recipient')} | {field_key for _, field_key, _ in columns},
+    }
+
+def to_text(value):
+    return '' if value is None else str(value)
+
+# Yield the devices of one ticket, one per IMEI, with values as text exactly as they are written to the CSV
+def extract_ticket_rows(ticket, plan):
+    custom_fields = {str(field['id']): field['value'] for field in ticket.get('custom_fields', [])}
+
+    imei_list = custom_fields.get(plan['imei'], '')
+    imei_values = [imei.strip().lstrip("'") for imei in (imei_list or '').split(',') if imei.strip()]
+    if not imei_values:
+        return
+
+    recipients_list = custom_fields.get(plan['recipient'], '')
+    recipients = [recipient.strip() for recipient in (recipients_list or '').split(',') if recipient.strip()]
+
+    # Every value but the IMEI and recipient is the same for all devices of the ticket
+    values = {}
+    for column, field_key, tag_to_name in plan['columns']:
+        value = custom_fields.get(field_key, 'N/A')
+        values[column] = to_text(value if tag_to_name is None else tag_to_name.get(value, 'N/A'))
+    group_id = ticket.get('group_id')
+    ticket_device = Device(
+        serial=values['Serial # Apple only'],
+        brand=values['Brand'],
+        model=values['Model'],
+        status=values['Status'],
+        deploy_date=values['Deploy Date'],
+        fulfilled_by=values['Fulfilled By'],
+        ticket=to_text(ticket.get('id', 'N/A')),
+        gl_code=values['GL Code - Facility Name'],
+        recipient='N/A',
+        notes=values['Notes'],
+        queue_id=to_text(QUEUE_ID if group_id == QUEUE_ID else 'N/A'),
+        waiting_queue_id=to_text(WAITING_QUEUE_ID if group_id == WAITING_QUEUE_ID else 'N/A'),
+        form_id=to_text(FORM_ID)
+    )
+
+    # Iterate through imei_values to build each one as a separate device
+    for i, imei in enumerate(imei_values):
+        yield ticket_device.replace(imei=imei, recipient=recipients[i % len(recipients)] if recipients else 'N/A')
+
+# Yield one Device per IMEI from the tickets, with values as text exactly as they are written to the CSV
+def iter_ticket_rows(tickets, field_ids, dropdown_mappings, plan=None):
+    plan = plan or compile_field_plan(field_ids, dropdown_mappings)
+    seen_rows = set()  # To track and avoid duplicates
+
+    for ticket in tickets:
+        for row in extract_ticket_rows(ticket, plan):
+            # The other values follow from the ticket, so the ticket, IMEI and recipient identify a row
+            row_key = (row.ticket, row.imei, row.recipient)
+
+            # Only keep unique rows
+            if row_key not in seen_rows:
+                seen_rows.add(row_key)
+                yield row
+
+# Build the list of rows for every ticket
+def build_ticket_rows(tickets, field_ids, dropdown_mappings, plan=None):
+    return list(iter_ticket_rows(tickets, field_ids, dropdown_mappings, plan))
 
 # Save tickets to CSV with the specified format
-def save_tickets_to_csv(tickets, field_ids, dropdown_mappings):
+def save_tickets_to_csv(tickets, field_ids, dropdown_mappings, plan=None):
     script_dir = os.path.dirname(__file__)
     tickets_file = os.path.join(script_dir, 'zendesk_tickets.csv')
-    seen_rows = set()  # To track and avoid duplicates
+    rows = build_ticket_rows(tickets, field_ids, dropdown_mappings, plan)
 
     try:
-        with open(tickets_file, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['IMEI #', 'Serial # Apple only', 'Brand', 'Model', 'Status', 'Deploy Date',
-                          'Fulfilled By', 'Ticket #', 'GL Code - Facility Name', 'Recipient', 'Notes',
-                          'QUEUE_ID', 'WAITING_QUEUE_ID', 'FORM_ID']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for ticket in tickets:
-                custom_fields = {str(field['id']): field['value'] for field in ticket.get('custom_fields', [])}
-
-                gl_code_tag = custom_fields.get(str(field_ids.get('GL Code - Facility Name')), 'N/A')
-                gl_code_name = dropdown_mappings['GL Code - Facility Name']['tag_to_raw_name'].get(gl_code_tag, 'N/A')
-
-                imei_list = custom_fields.get(str(field_ids.get('IMEI #', 'N/A')), '')
-                imei_values = [imei.strip().lstrip("'") for imei in (imei_list or '').split(',') if imei.strip()]
-
-                recipients_list = custom_fields.get(str(field_ids.get('Recipient', 'N/A')), '')
-                recipients = [recipient.strip() for recipient in (recipients_list or '').split(',') if recipient.strip()]
-
-                # Iterate through imei_values to write each one as a separate row
-                for i, imei in enumerate(imei_values):
-                    row = {
-                        'IMEI #': imei,
-                        'Serial # Apple only': custom_fields.get(str(field_ids.get('Serial # Apple only', 'N/A')), 'N/A'),
-                        'Brand': dropdown_mappings['Brand']['tag_to_raw_name'].get(custom_fields.get(str(field_ids.get('Brand', 'N/A')), 'N/A'), 'N/A'),
-                        'Model': dropdown_mappings['Model']['tag_to_raw_name'].get(custom_fields.get(str(field_ids.get('Model', 'N/A')), 'N/A'), 'N/A'),
-                        'Status': dropdown_mappings['Status']['tag_to_raw_name'].get(custom_fields.get(str(field_ids.get('Status', 'N/A')), 'N/A'), 'N/A'),
-                        'Deploy Date': custom_fields.get(str(field_ids.get('Deploy Date', 'N/A')), 'N/A'),
-                        'Fulfilled By': dropdown_mappings['Fulfilled By']['tag_to_raw_name'].get(custom_fields.get(str(field_ids.get('Fulfilled By', 'N/A')), 'N/A'), 'N/A'),
-                        'Ticket #': ticket.get('id', 'N/A'),
-                        'GL Code - Facility Name': gl_code_name,
-                        'Recipient': recipients[i % len(recipients)] if recipients else 'N/A',
-                        'Notes': dropdown_mappings['Notes']['tag_to_raw_name'].get(custom_fields.get(str(field_ids.get('Notes', 'N/A')), 'N/A'), 'N/A'),
-                        'QUEUE_ID': QUEUE_ID if ticket.get('group_id') == QUEUE_ID else 'N/A',
-                        'WAITING_QUEUE_ID': WAITING_QUEUE_ID if ticket.get('group_id') == WAITING_QUEUE_ID else 'N/A',
-                        'FORM_ID': FORM_ID
-                    }
-
-                    # Convert the row values to strings
-                    row_tuple = tuple(f"{key}:{str(value)}" for key, value in row.items())
-
-                    # Only write unique rows
-                    if row_tuple not in seen_rows:
-                        writer.writerow(row)
-                        seen_rows.add(row_tuple)
-
+        write_csv(rows, tickets_file, TICKET_FIELDNAMES)
         logging.info(f"Tickets saved to {tickets_file}")
     except IOError as e:
         logging.error(f"Error saving tickets to CSV: {e}")
+    return rows
 
-
-def main():
-    try:
-        # Fetch all ticket field IDs from Zendesk
-        field_ids = fetch_ticket_fields()
+# Fetch the tickets and return their rows, raising if Zendesk cannot be read; the CSV is only written if asked for
+def fetch_ticket_rows(full_refresh=False, save_csv=True, field_metadata=None):
+    if field_metadata is not None:
+        # (field_ids, dropdown_mappings, field plan) already loaded by the caller, e.g. the sync daemon
+        field_ids, dropdown_mappings, plan = field_metadata
+    else:
+        # Load the ticket field IDs and dropdown mappings, from the local cache while they are unchanged
+        field_ids, dropdown_mappings = load_field_metadata()
         if not field_ids:
-            logging.error("No ticket fields fetched. Exiting.")
-            return
+            raise RuntimeError("No ticket fields fetched.")
 
-        # Fetch all dropdown mappings from Zendesk
-        dropdown_mappings = fetch_all_dropdown_mappings(field_ids)
+        plan = compile_field_plan(field_ids, dropdown_mappings)
 
-        # Fetch tickets from Zendesk
-        tickets = fetch_zendesk_tickets()
+    # Fetch tickets from Zendesk, incrementally unless a full refresh is requested, keeping only the fields the rows use
+    tickets = fetch_tickets_incremental(full_refresh=full_refresh, field_keys=plan['field_keys'])
+    metrics.increment('zendesk_tickets_fetched', len(tickets))
 
+    if not save_csv:
+        rows = build_ticket_rows(tickets, field_ids, dropdown_mappings, plan)
+    else:
         # Save tickets to CSV with the specified format
-        save_tickets_to_csv(tickets, field_ids, dropdown_mappings)
-        
+        rows = save_tickets_to_csv(tickets, field_ids, dropdown_mappings, plan)
+    metrics.increment('zendesk_rows', len(rows))
+    return rows
+
+
+def main(full_refresh=False):
+    try:
+        return fetch_ticket_rows(full_refresh=full_refresh)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
 
 if __name__ == '__main__':
-    main()
+    main(full_refresh='--full' in sys.argv)